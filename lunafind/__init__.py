@@ -24,5 +24,5 @@ from . import config
 config.reload()
 
 from .post import Post
-from .stream import Stream
-from .album import Album
+from .stream import AsyncStream, Stream
+from .album import Album, AsyncAlbum
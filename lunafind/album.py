@@ -1,14 +1,16 @@
 # Copyright 2018 miruka
 # This file is part of lunafind, licensed under LGPLv3.
 
+import asyncio
 import traceback
-from typing import Generator, List
+from pathlib import Path
+from typing import Generator, List, Optional, Union
 
-from . import LOG, order
+from . import LOG, config, order
 from .attridict import AttrIndexedDict
-from .filtering import filter_all
+from .filtering import compile_query, filter_all
 from .post import Post
-from .stream import Stream
+from .stream import AsyncStream, Stream, download_async
 
 
 class Album(AttrIndexedDict, attr="id", map_partials=("download",)):
@@ -71,15 +73,61 @@ class Album(AttrIndexedDict, attr="id", map_partials=("download",)):
 
 
     def filter(self, search: str, partial_tags: bool = False) -> "Album":
-        return Album(*self.filter_lazy(search, partial_tags))
+        return type(self)(*self.filter_lazy(search, partial_tags))
 
     def filter_lazy(self, search: str, partial_tags: bool = False
                    ) -> Generator[Post, None, None]:
-        yield from filter_all(self.list, search, partial_tags=partial_tags)
+        query = compile_query(search, partial_tags=partial_tags)
+        yield from filter_all(self.list, query)
 
-    def order(self, by: str) -> "Album":
-        return Album(*order.sort(self.list, by))
+    def order(self, by: str, top: Optional[int] = None) -> "Album":
+        return type(self)(*order.sort(self.list, by, top))
 
     __truediv__  = lambda self, search: self.filter(search)        # /
     __floordiv__ = lambda self, search: self.filter(search, True)  # //
     __mod__      = lambda self, by:     self.order(by)             # %
+
+
+class AsyncAlbum(Album, attr="id"):
+    """Album able to consume several streams at once and download posts
+    asynchronously.
+
+    The constructor adds posts synchronously like Album's, use
+    `await album.put_async(...)` from a coroutine instead."""
+
+    async def put_async(self,
+                        *posts_streams: Union[Post, Stream, AsyncStream],
+                        concurrency:    Optional[int] = None
+                       ) -> "AsyncAlbum":
+        "Add posts, consuming up to `concurrency` streams at once."
+
+        limit       = concurrency or \
+                      int(config.CFG["GENERAL"]["parallel_requests"])
+        semaphore   = asyncio.Semaphore(limit)
+        self._added = 0
+
+        async def consume(stream: Union[Stream, AsyncStream]) -> None:
+            if isinstance(stream, Stream):
+                stream = AsyncStream(_stream=stream)
+
+            async with semaphore:
+                async for post in stream:
+                    self._put_post(post)
+
+        for post in posts_streams:
+            if isinstance(post, Post):
+                self._put_post(post)
+
+        await asyncio.gather(*(consume(s) for s in posts_streams
+                               if not isinstance(s, Post)))
+        return self
+
+
+    async def download(self,
+                       base_dir:    Union[str, Path] = Path("."),
+                       overwrite:   bool             = False,
+                       warn:        bool             = True,
+                       concurrency: Optional[int]    = None
+                      ) -> "AsyncAlbum":
+        await download_async(self.list, base_dir, overwrite, warn, concurrency)
+        return self
@@ -0,0 +1,230 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+"""Filter posts in batches, evaluating numeric terms with NumPy.
+
+Only used if NumPy is installed (`pip3 install lunafind[fast]`).
+Results are the same as filtering posts one by one."""
+
+import itertools
+from typing import Any, Dict, Generator, Iterable, List, Optional, Tuple, Union
+
+from . import LOG, utils
+from .clients.base import InfoType
+from .clients.columnar import INT_NONE, ColumnarIndex, ColumnarInfo
+from .filtering import (
+    META_DATE_TAGS, META_NUM_TAGS, Matcher, MetaNumTerm, Query, safe_int
+)
+from .post import Post
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # pylint: disable=invalid-name
+
+# Terms comparing an info field converted to a number, tag: field
+NUM_FIELDS = {tag: spec[0] for tag, spec in META_NUM_TAGS.items()
+              if isinstance(spec[0], str) and
+              spec[1] in (safe_int, utils.human2bytes)}
+
+# Values from the columnar index: (values, valid mask, term values)
+ExtractType = Tuple[Any, Any, Tuple[Any, ...]]
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _vectorizable(term: Any) -> bool:
+    # "in" compares value strings, see MetaNumTerm._compare
+    return isinstance(term, MetaNumTerm) and term.op != "in" and \
+           (term.tag in NUM_FIELDS or term.derived is not None)
+
+
+def _compare(term: MetaNumTerm, info_v: Any, values: Tuple[Any, ...]) -> Any:
+    "Vectorized MetaNumTerm.present()."
+
+    op = term.op
+
+    if op == "none":
+        result = info_v == 0
+    elif op == "any":
+        result = info_v != 0
+    elif op == ">=":
+        result = info_v >= values[0]
+    elif op == "<=":
+        result = info_v <= values[0]
+    elif op == ">":
+        result = info_v > values[0]
+    elif op == "<":
+        result = info_v < values[0]
+    elif op == "range":
+        result = (values[0] <= info_v) & (info_v <= values[1])
+        result = ~result if term.reverse else result
+    elif op == "in_fuzzy":
+        result = np.zeros(len(info_v), dtype=bool)
+        for val in values:
+            result |= (val - val / 20 <= info_v) & (info_v <= val + val / 20)
+    elif op == "eq_fuzzy":
+        result = (values[0] - values[0] / 20 <= info_v) & \
+                 (info_v <= values[0] + values[0] / 20)
+    else:
+        result = info_v == values[0]
+
+    return ~result if term.reverse else result
+
+
+class BatchFilter:
+    """Match posts against a Query by batches.
+
+    Numeric terms of the required and excluded groups are evaluated for
+    a whole batch at once. Posts passing them are then matched against
+    the other terms one by one. Posts for which a numeric term can't be
+    evaluated that way (missing or None values) are matched entirely
+    one by one."""
+
+    def __init__(self,
+                 query:     Query,
+                 estimates: Optional[Dict[str, float]] = None) -> None:
+
+        self.terms = [t for t in query.required + query.excluded
+                      if _vectorizable(t)]
+
+        others = lambda terms: tuple(t for t in terms if not _vectorizable(t))
+        rest   = Query(others(query.required), others(query.excluded),
+                       query.any_of)
+
+        self._full = Matcher(query, estimates)
+        self._rest = Matcher(rest, estimates)
+
+        self._arrays: Dict[Tuple[int, str], Any] = {}
+
+
+    def _column(self, index: ColumnarIndex, name: str) -> Any:
+        try:
+            return self._arrays[id(index), name]
+        except KeyError:
+            col = index.column(name)
+            arr = self._arrays[id(index), name] = np.frombuffer(
+                col.values, dtype=np.float64 if col.kind == "float" else
+                                  np.int64
+            )
+            return arr
+
+
+    def _from_columns(self, term: MetaNumTerm, index: ColumnarIndex,
+                      rows: Any) -> Optional[ExtractType]:
+
+        if term.derived in index.derived:
+            name, values = term.derived, term.derived_values
+        elif index.kinds.get(NUM_FIELDS.get(term.tag)) == "int":
+            name, values = NUM_FIELDS[term.tag], term.values
+        else:
+            return None
+
+        info_v = self._column(index, name)[rows]
+        valid  = ~np.isnan(info_v) if info_v.dtype == np.float64 else \
+                 info_v != INT_NONE
+
+        return (info_v, valid, values)
+
+
+    @staticmethod
+    def _from_infos(term: MetaNumTerm, infos: List[InfoType]) -> ExtractType:
+        info_v = [0] * len(infos)
+        valid  = np.ones(len(infos), dtype=bool)
+
+        # Dates would need to be converted, leave them to the slow path
+        if term.tag in META_DATE_TAGS:
+            valid[:] = False
+            return (None, valid, term.values)
+
+        for i, info in enumerate(infos):
+            try:
+                value = term.get(info)
+            except Exception:  # Raised again by the slow path if needed
+                valid[i] = False
+                continue
+
+            if type(value) in (int, float):
+                info_v[i] = value
+            else:
+                valid[i] = False
+
+        return (np.array(info_v), valid, term.values)
+
+
+    def _evaluate(self, infos: List[InfoType]
+                 ) -> Tuple[List[bool], List[bool]]:
+        "Return (passed numeric terms, needs slow path) lists for infos."
+
+        index = rows = None
+
+        if isinstance(infos[0], ColumnarInfo):
+            index = infos[0].index
+
+            if all(isinstance(i, ColumnarInfo) and i.index is index
+                   for i in infos):
+                rows = np.fromiter((i.row for i in infos), dtype=np.int64,
+                                   count=len(infos))
+
+        passed = np.ones(len(infos),  dtype=bool)
+        slow   = np.zeros(len(infos), dtype=bool)
+
+        for term in self.terms:
+            extracted = None
+
+            if rows is not None:
+                extracted = self._from_columns(term, index, rows)
+
+            if extracted is None:
+                extracted = self._from_infos(term, infos)
+
+            info_v, valid, values = extracted
+            slow |= ~valid
+
+            if not valid.any():
+                continue
+
+            present = _compare(term, info_v, values)
+            passed &= ~present if term.prefix == "-" else present
+
+        return (passed.tolist(), slow.tolist())
+
+
+    def filter(self,
+               items:      Iterable[Union[InfoType, Post]],
+               batch_size: int = 1024,
+              ) -> Generator[Union[InfoType, Post], None, int]:
+
+        discarded = 0
+        items     = iter(items)
+
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+
+            if not batch:
+                return discarded
+
+            infos        = [i.info if isinstance(i, Post) else i
+                            for i in batch]
+            passed, slow = self._evaluate(infos)
+
+            for item, info, passed_num, slow_path in \
+                    zip(batch, infos, passed, slow):
+
+                if not (passed_num or slow_path):
+                    discarded += 1
+                    continue
+
+                matcher = self._full if slow_path else self._rest
+
+                try:
+                    if matcher.match(info):
+                        yield item
+                    else:
+                        discarded += 1
+
+                except KeyError as err:
+                    LOG.warning("No %r key for post %d.",
+                                err.args[0], info["id"])
@@ -37,13 +37,23 @@ Options:
     - A range with an optional step: `3-6`, `10-end`, `1-20-2` (skip 1/2 pages)
     - A comma-separated list of pages: `1,3,5,12,99`
 
+    For Danbooru, `all`, ranges going to the end or past page 1000 and
+    ranges of 20 pages or more are fetched one after another, each page
+    continuing from the IDs of the previous one. This keeps deep pages fast
+    and lifts the page 1000 limit, but only works for searches ordered by ID
+    (the default, `order:id` or `order:id_desc`). Ranges starting after
+    page 1000 are reached by going through the posts before them,
+    200 per request.
+    Other pages are requested a few at a time in advance.
+
   -l NUM, --limit NUM
     Number of posts per page.
+    With `-o`/`--order`, number of best posts to get instead (all for `-1`),
+    see that option for details.
 
-    For Danbooru, default is `20`, max is `200`, and the max page with the
-    default limit for non-premium users is `1000`.
-    Using `--limit 200` allows more total posts to be fetched,
-    20K vs 80K with some big tags. Timeouts start to appear near pages 400-500.
+    For Danbooru, default is `20`, max is `200`, and the max page for
+    non-premium users is `1000` (see `-p`/`--pages` for when it applies).
+    Using `--limit 200` makes fewer requests for the same number of posts.
     After 5 fatal timeouts (which are each retried a few times), the search
     will give up and return what was found until then.
 
@@ -52,8 +62,8 @@ Options:
 
   -r, --random
     Get results in a randomized order.
-    For local posts, all results have to be loaded in RAM in order to be
-    effectively randomized, this could take some time.
+    For local posts, using a limit is recommended: without one, all results
+    have to be loaded in RAM in order to be effectively randomized.
 
   -w, --raw
     Do not parse the query for aliased tags, metatags or multiple tags,
@@ -70,6 +80,20 @@ Options:
     If not specified, the default booru from your config file is used.
     This option is ignored for URL/path queries with `q`/`--query-location`.
 
+  --reindex
+    For a local directory `SOURCE`, check every post directory for
+    modifications and update the index before searching.
+    Added or removed post directories are always detected without this.
+
+  --no-cache
+    Do not use or save cached booru API responses.
+    Responses are normally kept on disk from a few minutes (searches, post
+    counts) to an hour (post info, notes, artist commentaries), and are
+    revalidated with the booru after that.
+
+  --refresh-cache
+    Revalidate cached booru API responses even if they are recent.
+
 
   -f TAGS, --filter TAGS
     Filter posts returned by searches,
@@ -95,11 +119,18 @@ Options:
 
   -o BY, --order BY
     Order posts returned by searches.
-    Has to force all results to be fetched at the start and loaded in RAM.
     See `--help-order-values` to get a list of the possible `BY` values.
 
-    Also remember this works with actually fetched results.
-    The equivalent to searching "tag1 tag2 order:score" on Danbooru would be:
+    For a single booru search, if the booru supports the ordering and the
+    search has less tags than its limit (2 for Danbooru), the booru orders
+    posts itself. Only the pages needed are fetched, and `-l`/`--limit` is
+    the number of top posts to get, e.g. for the 200 best posts by score:
+    `lunafind "tag1" --pages all --limit 200 --order score`
+
+    Otherwise, all results have to be fetched at the start.
+    Results not fitting in memory are temporarily sorted on disk.
+    If `-l`/`--limit` is also used, only that many best posts are kept.
+    Remember this works with actually fetched results, e.g.
     `lunafind "tag1 tag2" --pages all --order score` (notice `--pages all`).
 
 
@@ -217,21 +248,37 @@ Examples:
     "scenery OR landscape" and "outdoor OR nature", pages 1 to 10,
     combine the results and download everything."""
 
+import itertools
 import re
 import sys
 from pathlib import Path
 from types import GeneratorType
-from typing import List, Optional
+from typing import Generator, List, Optional, Set
 
 import docopt
 from colorama import Fore
 
-from . import LOG, Album, Stream, __about__, config, order, utils
+from . import LOG, Album, Post, Stream, __about__, config, order, utils
+from .clients import auto, httpcache
+from .clients.local import Local
+
+# Serialized posts size after which --order sorts them on disk
+ORDER_MAX_MEMORY = 256 * 1024 ** 2
 
 OPTIONS = [string for match in re.findall(r"(-.)(?:\s|,)|(--.+?)\s", __doc__)
            for string in match if string]
 
 
+def unique_posts(streams: List[Stream]) -> Generator[Post, None, None]:
+    seen: Set[int] = set()
+
+    for stream in streams:
+        for post in stream:
+            if post.id not in seen:
+                seen.add(post.id)
+                yield post
+
+
 def print_order_values() -> None:
     dicts     = {**order.ORDER_NUM, **order.ORDER_DATE, **order.ORDER_FUNCS}
     by_maxlen = len(max(dicts.keys(), key=len))
@@ -290,6 +337,19 @@ def main(argv: Optional[List[str]] = None) -> None:
 
     params = {k: v for k, v in params.items() if v is not None}
 
+    if args["--reindex"]:
+        params["client"] = auto.get(params.get("client"))
+
+        if isinstance(params["client"], Local):
+            params["client"].refresh(full=True)
+        else:
+            LOG.warning("--reindex only has an effect for local sources.")
+
+    if args["--no-cache"]:
+        httpcache.shared().mode = "bypass"
+    elif args["--refresh-cache"]:
+        httpcache.shared().mode = "refresh"
+
     unesc = lambda s: s[1:] if s.startswith(r"\-") or s.startswith("%-") else s
 
     stores = [
@@ -302,10 +362,22 @@ def main(argv: Optional[List[str]] = None) -> None:
         for q in args["QUERY"] or ("",)
     ]
 
-    if args["--order"]:
-        stores = [
-            sum([Album(s) for s in stores], Album()).order(args["--order"])
-        ]
+    ordered = None
+    # Negative limits are infinite for local sources, not a number of posts
+    top     = order.parse_top(params.get("limit"))
+
+    if args["--order"] and len(stores) == 1:
+        ordered = stores[0].natively_ordered(args["--order"])
+
+    if ordered:
+        # The booru orders posts, the limit gives the number of top posts
+        stores = [itertools.islice(ordered, top)]
+
+    elif args["--order"]:
+        # With a limit, only keep the best posts while fetching them all
+        stores = [order.sort(unique_posts(stores), args["--order"],
+                             top        = top,
+                             max_memory = ORDER_MAX_MEMORY)]
 
 
     if not (args["--resource"] or args["--show-location"] or
@@ -313,14 +385,17 @@ def main(argv: Optional[List[str]] = None) -> None:
         args["--resource"] = "info"
 
     for obj in stores:
-        posts = obj.list if isinstance(obj, Album) else obj
-
         if args["--download"]:
-            posts.download(base_dir  = args["--download"],
-                           overwrite = args["--overwrite"],
-                           warn      = not args["--quiet-skip"])
+            if not isinstance(obj, (Album, Stream)):
+                obj = Album(*obj)
+
+            obj.download(base_dir  = args["--download"],
+                         overwrite = args["--overwrite"],
+                         warn      = not args["--quiet-skip"])
             continue
 
+        posts = obj.list if isinstance(obj, Album) else obj
+
         try:
             for post in posts:
                 if args["--show-location"]:
@@ -0,0 +1,230 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+"""Asyncio network transport for NetClient async methods.
+
+Only usable if aiohttp is installed (`pip3 install lunafind[async]`).
+Call `await aionet.close()` before the event loop ends to close the
+connections of the shared transport."""
+
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from typing import AsyncGenerator, Optional, Tuple
+
+from .. import LOG, config
+from .net import RETRY
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # pylint: disable=invalid-name
+
+AuthType = Optional[Tuple[str, str]]
+
+
+def available() -> bool:
+    return aiohttp is not None
+
+
+class TransportError(Exception):
+    "Raised when a response body couldn't be entirely received."
+
+
+def _retry_after(value: Optional[str], default: float) -> float:
+    "Return seconds to wait from a Retry-After header, number or date."
+    if value is None:
+        return default
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return default
+
+
+class Transport:
+    """aiohttp session and concurrency limit shared by async requests.
+
+    The session is created on first use for the running event loop, and
+    recreated if requests are later made from another loop.
+    close() must be awaited before the loop ends to close connections."""
+
+    def __init__(self,
+                 limit:   Optional[int] = None,
+                 timeout: float         = 6.5) -> None:
+        if not available():
+            raise RuntimeError("aiohttp must be installed for async requests, "
+                               "run `pip3 install lunafind[async]`.")
+
+        self.limit:   int   = \
+            limit or int(config.CFG["GENERAL"]["parallel_requests"])
+        self.timeout: float = timeout
+
+        self._session:   Optional["aiohttp.ClientSession"]   = None
+        self._semaphore: Optional[asyncio.Semaphore]         = None
+        self._loop:      Optional[asyncio.AbstractEventLoop] = None
+
+
+    async def _get_session(self) -> "aiohttp.ClientSession":
+        loop = asyncio.get_event_loop()
+
+        if self._session is None or self._session.closed or \
+           self._loop is not loop:
+            old_session, old_loop = self._session, self._loop
+
+            self._loop      = loop
+            self._semaphore = asyncio.Semaphore(self.limit)
+            self._session   = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(limit=self.limit),
+                timeout   = aiohttp.ClientTimeout(sock_connect = self.timeout,
+                                                  sock_read    = self.timeout)
+            )
+
+            if old_session and not old_session.closed:
+                await self._close_session(old_session, old_loop)
+
+        return self._session
+
+
+    @staticmethod
+    async def _close_session(session: "aiohttp.ClientSession",
+                             loop:    asyncio.AbstractEventLoop) -> None:
+        """Close a session made for another event loop than the current one.
+
+        Its connections are closed by that loop, when it runs again if it's
+        not running in another thread. They were already lost if it's closed,
+        the session is then just marked as closed."""
+
+        if loop.is_closed():
+            await session.close()
+        else:
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+
+    async def close(self) -> None:
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+    async def _request(self,
+                       http_method: str,
+                       url:         str,
+                       auth:        AuthType = None,
+                       **request_kwargs
+                      ) -> Optional["aiohttp.ClientResponse"]:
+        "Return a response to release after use, None if the request failed."
+
+        session = await self._get_session()
+        auth    = aiohttp.BasicAuth(*auth) if auth else None
+
+        # aiohttp only accepts str/int/float parameter values
+        if request_kwargs.get("params"):
+            request_kwargs["params"] = {
+                k: str(v) for k, v in request_kwargs["params"].items()
+            }
+
+        for attempt in range(RETRY.total + 1):
+            last = attempt == RETRY.total
+            wait = RETRY.backoff_factor * 2 ** attempt
+
+            try:
+                response = await session.request(
+                    http_method, url, auth=auth, **request_kwargs
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if last:
+                    LOG.error("%s: %s", url, err or type(err).__name__)
+                    return None
+
+                await asyncio.sleep(wait)
+                continue
+
+            if response.status in RETRY.status_forcelist and not last:
+                wait = _retry_after(response.headers.get("Retry-After"), wait)
+                response.release()
+                await asyncio.sleep(wait)
+                continue
+
+            try:
+                response.raise_for_status()
+            except aiohttp.ClientResponseError as err:
+                response.release()
+                LOG.error(str(err))
+                return None
+
+            return response
+
+        return None
+
+
+    async def read(self, http_method: str, url: str, **request_kwargs
+                  ) -> Optional[bytes]:
+        "Return the body of a response, None if the request failed."
+
+        await self._get_session()
+
+        async with self._semaphore:
+            response = await self._request(http_method, url, **request_kwargs)
+
+            if response is None:
+                return None
+
+            try:
+                return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                LOG.error("%s: %s", url, err or type(err).__name__)
+                return None
+            finally:
+                response.release()
+
+
+    async def stream(self,
+                     http_method: str,
+                     url:         str,
+                     chunk_size:  int = 8 * 1024 ** 2,
+                     **request_kwargs) -> AsyncGenerator[bytes, None]:
+        """Yield chunks of a response body, nothing if the request failed.
+
+        Raise TransportError if the body is interrupted, the chunks already
+        yielded are then incomplete."""
+
+        await self._get_session()
+
+        async with self._semaphore:
+            response = await self._request(http_method, url, **request_kwargs)
+
+            if response is None:
+                return
+
+            try:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    yield chunk
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                raise TransportError(
+                    f"{url}: {err or type(err).__name__}"
+                ) from err
+            finally:
+                response.release()
+
+
+SHARED: Optional[Transport] = None
+
+def shared() -> Transport:
+    "Return the transport used by clients that don't have their own."
+    global SHARED  # pylint: disable=global-statement
+
+    if SHARED is None:
+        SHARED = Transport()
+
+    return SHARED
+
+
+async def close() -> None:
+    "Close the shared transport's connections, if it was used."
+    if SHARED is not None:
+        await SHARED.close()
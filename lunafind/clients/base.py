@@ -4,7 +4,10 @@
 import abc
 import math
 from pathlib import Path
-from typing import Any, Dict, Generator, Iterable, List, Optional, Tuple, Union
+from typing import (
+    Any, AsyncGenerator, Dict, FrozenSet, Generator, Iterable, Iterator, List,
+    Optional, Tuple, Union
+)
 
 import pendulum as pend
 from dataclasses import dataclass, field
@@ -12,8 +15,11 @@ from dataclasses import dataclass, field
 # pylint: disable=no-name-in-module
 from fastnumbers import fast_int as fint
 
-InfoType    = Union[Dict[str, Any], "IndexedInfo"]
-InfoGenType = Generator[InfoType, None, None]
+from .. import utils
+
+InfoType         = Union[Dict[str, Any], "LazyInfo"]
+InfoGenType      = Generator[InfoType, None, None]
+AsyncInfoGenType = AsyncGenerator[InfoType, None]
 
 IE       = Union[int, type(Ellipsis)]
 PageType = Union[IE, str, Tuple[IE, IE], Tuple[IE, IE, IE], Iterable[int]]
@@ -22,6 +28,101 @@ ArtcomType = NotesType = List[Dict[str, Any]]
 MediaType  = Optional[Generator[bytes, None, None]]
 
 
+class LazyInfo(abc.ABC):
+    """Read-only post info mapping, loading fields on first access.
+
+    Loaded values are cached per object. Fields can be accessed with
+    info["key"], info.key or by position with info[n]."""
+
+    __slots__ = ("_cache", "_tag_set")
+
+    def __init__(self) -> None:
+        self._cache:   Dict[str, Any]      = {}
+        self._tag_set: Optional[FrozenSet] = None
+
+
+    @abc.abstractmethod
+    def keys(self) -> Iterable[str]:
+        return ()
+
+
+    @abc.abstractmethod
+    def _load(self, key: str) -> Any:
+        raise KeyError(key)
+
+
+    def __getitem__(self, key: Union[str, int]) -> Any:
+        if isinstance(key, int):
+            key = list(self.keys())[key]
+
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        value = self._cache[key] = self._load(key)
+        return value
+
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys()
+
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+
+    def __repr__(self) -> str:
+        return "%s(%s)" % (type(self).__name__,
+                           ", ".join(f"{k}={v!r}" for k, v in self.items()))
+
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return ((k, self[k]) for k in self.keys())
+
+
+    def values(self) -> Iterator[Any]:
+        return (self[k] for k in self.keys())
+
+
+    def tag_set(self) -> FrozenSet[str]:
+        "Return the tags from tag_string as a set, split only once."
+        if self._tag_set is None:
+            self._tag_set = frozenset(self["tag_string"].split())
+        return self._tag_set
+
+
+    def derived(self, name: str) -> Any:
+        "Return a value precomputed from fields, None if not available."
+        return None
+
+
+    # Used by simplejson to serialize us like namedtuples
+    def _asdict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+
 @dataclass
 class Client(abc.ABC):
     name: str = "client"
@@ -35,6 +136,12 @@ class Client(abc.ABC):
         yield {}
 
 
+    def info_md5s(self, md5s: Iterable[str]) -> InfoGenType:
+        "Yield info for the posts having any of the given MD5 hashes."
+        for md5 in md5s:
+            yield from self.info_md5(md5)
+
+
     @abc.abstractmethod
     def info_search(self,
                     tags:   str           = "",
@@ -76,6 +183,20 @@ class Client(abc.ABC):
         return ""
 
 
+    def tag_frequencies(self, tags: Iterable[str]) -> Dict[str, float]:
+        "Return known proportions of posts having these tags, if any."
+        return {}
+
+
+    def ordered_search(self, tags: str, by: str, descending: bool
+                      ) -> Optional[str]:
+        """Return a search for tags with results ordered by the client.
+
+        by is an `order` module method name. None is returned if the
+        client can't order results this way itself."""
+        return None
+
+
     @staticmethod
     def _parse_pages(pages: PageType, last_page: int) -> Iterable[int]:
         is_str = isinstance(pages, str)
@@ -103,15 +224,28 @@ class Client(abc.ABC):
 
 
     @staticmethod
-    def get_post_rank(post: "Post") -> int:
-        score = post.info["score"]
+    def get_post_rank(post: "Post", now: Optional[int] = None
+                     ) -> Optional[float]:
+        "Return the rank of a post at `now` (epoch microseconds)."
+
+        info  = post.info
+        score = info["score"]
 
         if score < 1:
             return score
 
-        post_date = pend.parse(post.info["created_at"])
+        epoch = info.derived("created_at_epoch") \
+                if isinstance(info, LazyInfo) else None
+
+        if epoch is None:
+            epoch = utils.iso2epoch(info["created_at"])
+
+            if epoch is None:
+                return None
+
+        now = utils.date2epoch(pend.now()) if now is None else now
 
-        if post_date > pend.now().subtract(days=2):
+        if epoch > now - 2 * 86_400 * 1_000_000:  # 2 days
             return -1
 
-        return math.log(score, 3) + post_date.timestamp() / 35_000
+        return math.log(score, 3) + epoch / 1_000_000 / 35_000
@@ -0,0 +1,409 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+"Columnar binary post index, read through memory-mapped files."
+
+import collections
+import itertools
+import math
+import mmap
+import os
+import shutil
+import weakref
+from array import array
+from pathlib import Path
+from typing import (
+    Any, BinaryIO, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+)
+
+import simplejson
+from atomicfile import AtomicFile
+
+# pylint: disable=no-name-in-module
+from fastnumbers import fast_float, fast_int
+
+from .. import LOG
+from .base import LazyInfo
+from .tagindex import StatType
+
+FORMAT_VERSION = 3
+
+# Sentinel for None in integer columns
+INT_NONE = -2 ** 63
+
+# int:    fixed-width int64 column (.i64)
+# float:  fixed-width float64 column, NaN for None (.f64)
+# bool:   fixed-width int8 column, -1 for None (.i8)
+# intern: int32 codes (.codes) into a list of distinct strings (.dict)
+# str:    utf-8 blob (.blob) with int64 start offsets for each row (.off)
+KINDS = ("int", "float", "bool", "intern", "str")
+
+# Column name: (kind, function returning the value from a row of strings)
+DerivedType = Dict[str, Tuple[str, Callable[[Sequence[str]], Any]]]
+
+BUFFER_ROWS = 8192
+
+# Indexes in use by this process: builds don't remove their files, which
+# are only mapped when a column is first read.
+_OPEN: "weakref.WeakSet[ColumnarIndex]" = weakref.WeakSet()
+
+
+class _ColumnWriter:
+    def __init__(self, directory: Path, name: str, kind: str) -> None:
+        self.kind  = kind
+        self.files = {}
+        self.dict: Dict[str, int] = {}
+
+        def open_(ext: str) -> BinaryIO:
+            self.files[ext] = open(directory / f"{name}.{ext}", "wb")
+            return self.files[ext]
+
+        if kind == "int":
+            self.file, self.buf = open_("i64"), array("q")
+        elif kind == "float":
+            self.file, self.buf = open_("f64"), array("d")
+        elif kind == "bool":
+            self.file, self.buf = open_("i8"), array("b")
+        elif kind == "intern":
+            self.file, self.buf = open_("codes"), array("i")
+        else:
+            self.file, self.buf = open_("off"), array("q")
+            self.blob, self.pos = open_("blob"), 0
+            self.buf.append(0)
+
+        self.dict_path = directory / f"{name}.dict"
+
+
+    def add(self, value: Any) -> None:
+        if self.kind == "int":
+            self.buf.append(INT_NONE if value is None else
+                            fast_int(value, INT_NONE))
+
+        elif self.kind == "float":
+            self.buf.append(math.nan if value is None else
+                            fast_float(value, math.nan))
+
+        elif self.kind == "bool":
+            self.buf.append(1 if value == "True"  else
+                            0 if value == "False" else -1)
+
+        elif self.kind == "intern":
+            self.buf.append(self.dict.setdefault(value, len(self.dict)))
+
+        else:
+            data      = value.encode()
+            self.pos += len(data)
+            self.blob.write(data)
+            self.buf.append(self.pos)
+
+        if len(self.buf) >= BUFFER_ROWS:
+            self.flush()
+
+
+    def flush(self) -> None:
+        self.buf.tofile(self.file)
+        del self.buf[:]
+
+
+    def close(self) -> None:
+        self.flush()
+
+        for file in self.files.values():
+            file.close()
+
+        if self.kind == "intern":
+            self.dict_path.write_text(simplejson.dumps(list(self.dict)))
+
+
+class _Column:
+    def __init__(self, directory: Path, name: str, kind: str) -> None:
+        self.kind  = kind
+        self.maps: List[mmap.mmap] = []
+
+        if kind == "int":
+            self.values = self._map(directory / f"{name}.i64", "q")
+        elif kind == "float":
+            self.values = self._map(directory / f"{name}.f64", "d")
+        elif kind == "bool":
+            self.values = self._map(directory / f"{name}.i8", "b")
+        elif kind == "intern":
+            self.values  = self._map(directory / f"{name}.codes", "i")
+            self.strings = simplejson.loads(
+                (directory / f"{name}.dict").read_text()
+            )
+        else:
+            self.offsets = self._map(directory / f"{name}.off", "q")
+            self.blob    = self._map(directory / f"{name}.blob", "B")
+
+
+    def _map(self, path: Path, typecode: str) -> Sequence:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return array(typecode)
+
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.maps.append(mapped)
+        return memoryview(mapped).cast(typecode)
+
+
+    def __getitem__(self, row: int) -> Any:
+        if self.kind == "int":
+            value = self.values[row]
+            return None if value == INT_NONE else value
+
+        if self.kind == "float":
+            value = self.values[row]
+            return None if math.isnan(value) else value
+
+        if self.kind == "bool":
+            value = self.values[row]
+            return None if value == -1 else bool(value)
+
+        if self.kind == "intern":
+            return self.strings[self.values[row]]
+
+        return str(self.blob[self.offsets[row]:self.offsets[row + 1]],
+                   "utf-8")
+
+
+    def close(self) -> None:
+        for attr in ("values", "offsets", "blob"):
+            view = getattr(self, attr, None)
+            if isinstance(view, memoryview):
+                view.release()
+
+        for mapped in self.maps:
+            mapped.close()
+
+
+class ColumnarInfo(LazyInfo):
+    "Post info fetching its values from a ColumnarIndex."
+
+    __slots__ = ("_index", "_row")
+
+    def __init__(self, index: "ColumnarIndex", row: int) -> None:
+        super().__init__()
+        self._index = index
+        self._row   = row
+
+
+    @property
+    def index(self) -> "ColumnarIndex":
+        return self._index
+
+
+    @property
+    def row(self) -> int:
+        "Position of the post in its index."
+        return self._row
+
+
+    def keys(self) -> Iterable[str]:
+        return self._index.kinds.keys()
+
+
+    def _load(self, key: str) -> Any:
+        if key not in self._index.kinds:
+            raise KeyError(key)
+        return self._index.column(key)[self._row]
+
+
+    def derived(self, name: str) -> Any:
+        if name not in self._index.derived:
+            return None
+        return self._index.column(name)[self._row]
+
+
+class ColumnarIndex:
+    """Post index where every field is stored in its own file.
+
+    Only the columns a search actually reads are mapped and paged in.
+    Besides the info fields, derived columns can store values computed
+    from them at build time.
+
+    Column files are in a numbered sub directory named in meta.json.
+    Rebuilds write a new one, so that indexes still in use can keep their
+    files mapped (which prevents replacing or deleting them on Windows).
+    Older ones are removed by later builds once no index uses them."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        meta      = simplejson.loads((path / "meta.json").read_text())
+        self.data = path / str(meta["generation"])
+
+        self.rows:    int                = meta["rows"]
+        self.source:  Optional[StatType] = tuple(meta["source"] or ()) or None
+        self.kinds:   Dict[str, str]     = \
+            collections.OrderedDict(meta["columns"])
+        self.derived: Dict[str, str]     = dict(meta["derived"])
+
+        self._columns: Dict[str, _Column]          = {}
+        self._sorted:  Dict[Tuple[str, bool], bool] = {}
+
+        _OPEN.add(self)
+
+
+    @classmethod
+    def open(cls, path: Path, source: Optional[StatType] = None
+            ) -> Optional["ColumnarIndex"]:
+        "Open an index, return None if it is missing or out of sync."
+        try:
+            meta = simplejson.loads((path / "meta.json").read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if meta.get("version") != FORMAT_VERSION or \
+           (source and tuple(meta.get("source") or ()) != source):
+            return None
+
+        return cls(path)
+
+
+    @classmethod
+    def build(cls,
+              path:   Path,
+              kinds:  Dict[str, str],
+              rows:    Iterable[Sequence[str]],
+              source:  Optional[StatType]    = None,
+              derived: Optional[DerivedType] = None) -> List[int]:
+        """Write an index from rows of strings, replacing any existing one.
+
+        Returns the 1-based numbers of rows that were skipped because
+        they don't have enough fields."""
+
+        try:
+            meta       = simplejson.loads((path / "meta.json").read_text())
+            generation = int(meta["generation"]) + 1
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            generation = 1
+
+        # Left by a build that failed before switching to it, if any
+        tmp = path / str(generation)
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+
+        derived  = derived or {}
+        writers  = [_ColumnWriter(tmp, n, k) for n, k in kinds.items()]
+        computed = [(_ColumnWriter(tmp, n, k), func)
+                    for n, (k, func) in derived.items()]
+        count    = 0
+        bad_rows = []
+
+        for i, row in enumerate(rows, 1):
+            if len(row) < len(writers):
+                bad_rows.append(i)
+                continue
+
+            for writer, value in zip(writers, row):
+                writer.add(value)
+
+            for writer, func in computed:
+                writer.add(func(row))
+
+            count += 1
+
+        for writer in writers + [w for w, _ in computed]:
+            writer.close()
+
+        with AtomicFile(path / "meta.json", "w") as file:
+            file.write(simplejson.dumps({
+                "version":    FORMAT_VERSION,
+                "generation": generation,
+                "rows":       count,
+                "source":     source,
+                "columns":    list(kinds.items()),
+                "derived":    [(n, k) for n, (k, _) in derived.items()],
+            }))
+
+        cls._remove_unused(path, keep=tmp.name)
+
+        LOG.info("Wrote columnar index with %d posts.", count)
+        return bad_rows
+
+
+    @staticmethod
+    def _remove_unused(path: Path, keep: str) -> None:
+        """Remove previous generations and files from older index formats.
+
+        Generations used by open indexes are kept, as well as those still
+        mapped by other processes on Windows. Later builds remove them."""
+
+        used = {index.data.name for index in list(_OPEN)
+                if index.path == path}
+
+        for entry in path.iterdir():
+            if entry.name in (keep, "meta.json") or entry.name in used:
+                continue
+
+            try:
+                if entry.is_dir():
+                    shutil.rmtree(entry)
+                else:
+                    entry.unlink()
+            except OSError:
+                pass
+
+
+    def column(self, name: str) -> _Column:
+        try:
+            return self._columns[name]
+        except KeyError:
+            kind = self.kinds.get(name) or self.derived[name]
+            col  = self._columns[name] = _Column(self.data, name, kind)
+            return col
+
+
+    def is_sorted(self, name: str, reverse: bool = False) -> bool:
+        "Return whether the values of a numeric column are sorted."
+        try:
+            return self._sorted[name, reverse]
+        except KeyError:
+            pass
+
+        values = self.column(name).values
+        pairs  = zip(values, itertools.islice(values, 1, None))
+
+        self._sorted[name, reverse] = \
+            all(a >= b for a, b in pairs) if reverse else \
+            all(a <= b for a, b in pairs)
+
+        return self._sorted[name, reverse]
+
+
+    def search_sorted(self, name: str, value: int, reverse: bool = False
+                     ) -> range:
+        """Return the rows having a value in a sorted numeric column.
+
+        See is_sorted() to check if a column can be searched this way."""
+
+        values = self.column(name).values
+
+        def bisect(strict: bool) -> int:
+            low, high = 0, len(values)
+            while low < high:
+                mid = (low + high) // 2
+                val = values[mid]
+                if (val > value if reverse else val < value) or \
+                   (strict and val == value):
+                    low = mid + 1
+                else:
+                    high = mid
+            return low
+
+        return range(bisect(False), bisect(True))
+
+
+    def info(self, row: int) -> ColumnarInfo:
+        return ColumnarInfo(self, row)
+
+
+    def close(self) -> None:
+        for col in self._columns.values():
+            col.close()
+        self._columns.clear()
+        _OPEN.discard(self)
+
+
+    def __len__(self) -> int:
+        return self.rows
@@ -1,12 +1,19 @@
 # Copyright 2018 miruka
 # This file is part of lunafind, licensed under LGPLv3.
 
+import asyncio
+import collections
+import itertools
 import math
 import re
-from typing import Any, Dict, Optional, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any, AsyncGenerator, Deque, Dict, Iterator, List, Optional, Tuple, Union
+)
 from urllib.parse import parse_qs, urlparse
 
 import pendulum as pend
+import simplejson
 from dataclasses import dataclass, field
 
 # pylint: disable=no-name-in-module
@@ -16,6 +23,162 @@ from . import base, net
 from .. import LOG
 
 
+# Methods from the order module Danbooru supports: (ascending, descending)
+ORDERS = {
+    "id":             ("id",                 "id_desc"),
+    "score":          ("score_asc",          "score"),
+    "favcount":       ("favcount_asc",       "favcount"),
+    "filesize":       ("filesize_asc",       "filesize"),
+    "mpixels":        ("mpixels_asc",        "mpixels"),
+    "tagcount":       ("tagcount_asc",       "tagcount"),
+    "gentags":        ("gentags_asc",        "gentags"),
+    "arttags":        ("arttags_asc",        "arttags"),
+    "chartags":       ("chartags_asc",       "chartags"),
+    "copytags":       ("copytags_asc",       "copytags"),
+    "metatags":       ("metatags_asc",       "metatags"),
+    "change":         ("change_asc",         "change"),
+    "comment":        ("comment_asc",        "comment"),
+    "comm":           ("comment_asc",        "comment"),
+    "comment_bumped": ("comment_bumped_asc", "comment_bumped"),
+    "note":           ("note_asc",           "note"),
+}
+
+# Search orders allowing seek pagination, with the page=<prefix><id>
+# cursor prefix that continues them: b = before an ID, a = after
+SEEK_ORDERS = {None: "b", "id_desc": "b", "id": "a", "id_asc": "a"}
+
+# Metatags ordering results by something else than ID without order:
+ORDER_METATAGS = ("ordfav:", "ordpool:", "ordfavgroup:")
+
+
+# pylint: disable=protected-access
+@dataclass
+class _Pages:
+    """Search pages to fetch.
+
+    Fetching loops get requests from next_request() until it returns None,
+    and pass what they got for each to got(). They can make up to `ahead`
+    requests before getting their results."""
+
+    client:    "Danbooru"
+    params:    Dict[str, Any]
+    last_page: int
+    fails:     int = field(default=0, init=False)
+
+    ahead     = 1
+    fail_hint = ""
+
+    def next_request(self) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError()
+
+
+    def got(self, infos: Optional[List[base.InfoType]]
+           ) -> Optional[List[base.InfoType]]:
+        """Return the posts to give from a fetched page, None to stop.
+
+        `infos` is None if the page couldn't be fetched."""
+        raise NotImplementedError()
+
+
+    def _failed(self) -> bool:
+        "Count a failed page fetch, return if it's time to give up."
+        self.fails += 1
+
+        if self.fails < 5:
+            return False
+
+        LOG.error("Giving up after 5 consecutive page fetch fails%s.",
+                  self.fail_hint)
+        return True
+
+
+@dataclass
+class _NumberedPages(_Pages):
+    pages: Iterator[int]
+
+    fail_hint = ", pagination limit probably reached"
+
+    @property
+    def ahead(self) -> int:
+        return max(1, self.client.prefetch_pages)
+
+
+    def next_request(self) -> Optional[Dict[str, Any]]:
+        for page in self.pages:
+            self.client._log_page(self.params, page, self.last_page)
+            return {**self.params, "page": page}
+        return None
+
+
+    def got(self, infos: Optional[List[base.InfoType]]
+           ) -> Optional[List[base.InfoType]]:
+        if infos is None:
+            return None if self._failed() else []
+
+        self.fails = 0
+        return infos
+
+
+@dataclass
+class _SeekPages(_Pages):
+    """Pages to fetch with seek pagination, see Danbooru._seek_plan().
+
+    The first page is a normal one, the next ones are after its posts.
+    Pages past max_page can't be requested directly: the posts before
+    them are then skipped by seeking from the first page."""
+
+    prefix:  str
+    page:    int
+    last:    Optional[int]
+    request: Dict[str, Any] = field(default_factory=dict, init=False)
+    skip:    int            = field(default=0,            init=False)
+
+    def __post_init__(self) -> None:
+        if self.page <= self.client.max_page:
+            self.request = {**self.params, "page": self.page}
+            return
+
+        limit        = self.params.get("limit", self.client.default_limit)
+        self.request = {**self.params, "page": 1}
+        self.skip    = (self.page - 1) * limit
+        LOG.info("Skipping %d posts to reach page %d", self.skip, self.page)
+
+
+    def next_request(self) -> Optional[Dict[str, Any]]:
+        if self.last is not None and self.page > self.last:
+            return None
+
+        if not self.skip:
+            self.client._log_page(self.params, self.page, self.last_page)
+            return self.request
+
+        # Fetch big pages while posts are skipped
+        return {**self.request, "limit": min(self.skip, self.client.max_limit)}
+
+
+    def got(self, infos: Optional[List[base.InfoType]]
+           ) -> Optional[List[base.InfoType]]:
+        # Failed pages are requested again, next ones depend on their posts
+        if infos is None:
+            return None if self._failed() else []
+
+        # Post counts can be outdated, continue until there are no posts
+        if not infos:
+            return None
+
+        self.fails = 0
+        infos.sort(key=lambda info: info["id"], reverse=self.prefix == "b")
+        self.request = {**self.params,
+                        "page": f"{self.prefix}{infos[-1]['id']}"}
+
+        if self.skip:
+            self.skip = max(0, self.skip - len(infos))
+            return []
+
+        self.page += 1
+        return infos
+
+
 @dataclass
 class Danbooru(net.NetClient):
     name:      str = "danbooru"
@@ -23,8 +186,16 @@ class Danbooru(net.NetClient):
     username:  str = ""
     api_key:   str = ""
 
-    default_limit: int = field(default=20,  repr=False)
-    max_limit:     int = field(default=200, repr=False)
+    default_limit:  int = field(default=20,   repr=False)
+    max_limit:      int = field(default=200,  repr=False)
+    # Max number of tags in a search, including metatags like "order:"
+    tag_limit:      int = field(default=2,    repr=False)
+    # Number of search pages requested in advance while posts are consumed
+    prefetch_pages: int = field(default=4,    repr=False)
+    # Max page number for non-premium users
+    max_page:       int = field(default=1000, repr=False)
+    # Ranges with at least this many pages are fetched with seek pagination
+    seek_pages:     int = field(default=20,   repr=False)
 
     url_templates: Dict[str, str] = field(default_factory=dict, repr=False)
 
@@ -42,14 +213,23 @@ class Danbooru(net.NetClient):
         net.ALIVE[self.name] = self
 
 
-    def _api(self, endpoint_url: str, _catch_errs: bool = True, **params
-            ) -> Union[None, Any]:
+    @property
+    def _auth(self) -> Optional[Tuple[str, str]]:
+        return (self.username, self.api_key) \
+               if self.username and self.api_key else None
+
+
+    def _api(self,
+             endpoint_url: str,
+             _catch_errs:  bool          = True,
+             _cache_mode:  Optional[str] = None,
+             **params) -> Union[None, Any]:
         response = self.http(
             "get",
             f"{self.site_url}/{endpoint_url}",
-            params = params,
-            auth   = ((self.username, self.api_key)
-                      if self.username and self.api_key else None)
+            cache_mode = _cache_mode,
+            params     = params,
+            auth       = self._auth
         )
 
         if not _catch_errs:
@@ -97,7 +277,111 @@ class Danbooru(net.NetClient):
             yield from self.info_md5(tags.split(":")[1])
             return
 
-        params = {"tags": tags}
+        params = self._search_params(tags, limit, random, raw)
+        total  = self.count_posts(params["tags"])
+        plan   = self._search_plan(params, pages, limit, total)
+
+        if plan:
+            yield from self._fetch_pages(plan)
+
+
+    def _search_plan(self,
+                     params:      Dict[str, Any],
+                     pages:       base.PageType,
+                     limit:       Optional[int],
+                     total_posts: int) -> Optional[_Pages]:
+        "Return the pages to fetch for a search, None if it has no posts."
+        last_page = math.ceil(total_posts / (limit or self.default_limit))
+
+        if total_posts == 0 or last_page == 0:
+            LOG.warning("No posts for search %r.", params["tags"])
+            return None
+
+        seek = self._seek_plan(params, pages, last_page)
+
+        if seek:
+            return _SeekPages(self, params, last_page, *seek)
+
+        return _NumberedPages(self, params, last_page, (
+            p for p in self._parse_pages(pages, last_page) if p >= 1
+        ))
+
+
+    def _fetch_pages(self, plan: _Pages) -> base.InfoGenType:
+        requests = iter(plan.next_request, None)
+        pending: Deque[Future] = collections.deque()
+        executor = ThreadPoolExecutor(plan.ahead)
+
+        def request(params: Dict[str, Any]) -> None:
+            pending.append(executor.submit(self._search_page, params))
+
+        try:
+            for params in itertools.islice(requests, plan.ahead):
+                request(params)
+
+            while pending:
+                infos = plan.got(pending.popleft().result())
+
+                if infos is None:
+                    return
+
+                # Keep the next pages coming while posts are consumed
+                for params in itertools.islice(requests, 1):
+                    request(params)
+
+                yield from infos
+
+        finally:
+            for future in pending:
+                future.cancel()
+
+            executor.shutdown(wait=False)
+
+
+    def _seek_plan(self,
+                   params:    Dict[str, Any],
+                   pages:     base.PageType,
+                   last_page: int) -> Optional[Tuple[str, int, Optional[int]]]:
+        """Return how to fetch pages with seek pagination, if possible.
+
+        Seeking with `page=b<id>`/`a<id>` has no max page and stays fast
+        for deep pages, but each page needs the IDs of the previous one.
+        It is used for ranges going to the last page or having at least
+        `seek_pages` pages; not for shorter ones that can be prefetched,
+        or searches ordered by something else than ID (order:, ordfav:...).
+        Return (cursor prefix, first page, last page or None for all)."""
+
+        if "random" in params:
+            return None
+
+        tags   = params["tags"].lower().split() if "raw" not in params else []
+        orders = [t.split(":", 1)[1] for t in tags if t.startswith("order:")]
+
+        if any(t.startswith(ORDER_METATAGS) for t in tags):
+            return None
+
+        prefix = SEEK_ORDERS.get(orders[-1] if orders else None)
+        wanted = self._parse_pages(pages, last_page)
+
+        if not prefix or not isinstance(wanted, range) or \
+           wanted.step != 1 or not wanted:
+            return None
+
+        # Post counts can be outdated, continue until there are no posts
+        last = None if wanted[-1] >= last_page else wanted[-1]
+
+        if last and len(wanted) < self.seek_pages and last <= self.max_page:
+            return None
+
+        return (prefix, max(1, wanted[0]), last)
+
+
+    def _search_params(self,
+                       tags:   str,
+                       limit:  Optional[int],
+                       random: bool,
+                       raw:    bool) -> Dict[str, Any]:
+        params: Dict[str, Any] = {"tags": tags}
 
         if limit:
             params["limit"] = limit
@@ -112,46 +396,31 @@ class Danbooru(net.NetClient):
         if raw is True:
             params["raw"] = "true"
 
-        total_posts = self.count_posts(params["tags"])
-        last_page   = math.ceil(total_posts / (limit or self.default_limit))
+        return params
 
-        if total_posts == 0 or last_page == 0:
-            LOG.warning("No posts for search %r.", tags)
-            return
 
-        fails = 0
-        for page in self._parse_pages(pages, last_page):
-            if page < 1:
-                continue
+    @staticmethod
+    def _log_page(params: Dict[str, Any], page: int, last_page: int) -> None:
+        LOG.info(
+            "Fetching posts%s%s%s%s",
+            " for %r"       % params["tags"] if params["tags"] else "",
+            " on page %d%s" % (page, f"/{last_page}" if last_page else ""),
+            " [random]" if "random" in params else "",
+            " [raw]"    if "raw"    in params else ""
+        )
 
-            params["page"] = page
 
-            LOG.info(
-                "Fetching posts%s%s%s%s",
-                " for %r"       % params["tags"] if params["tags"] else "",
-                " on page %d%s" % (params["page"],
-                                   f"/{last_page}" if last_page else ""),
-                " [random]" if "random" in params else "",
-                " [raw]"    if "raw"    in params else ""
-            )
-
-            try:
-                search = self._api("posts.json", **params, _catch_errs=False)
-                for info in search:
-                    if "id" in info:
-                        yield info
-            except AttributeError:
-                fails += 1
-            except ValueError as err:
-                LOG.error(str(err))
-                fails += 1
-            else:
-                fails = 0
-
-            if fails >= 5:
-                LOG.error("Giving up after 5 consecutive page fetch fails, "
-                          "pagination limit probably reached.")
-                return
+    def _search_page(self, params: Dict[str, Any]
+                    ) -> Optional[List[base.InfoType]]:
+        "Return the posts of a search page, None if fetching it failed."
+        try:
+            search = self._api("posts.json", **params, _catch_errs=False)
+            return [info for info in search if "id" in info]
+        except AttributeError:
+            return None
+        except ValueError as err:
+            LOG.error(str(err))
+            return None
 
 
     def info_location(self, location: str) -> base.InfoGenType:
@@ -174,10 +443,17 @@ class Danbooru(net.NetClient):
         )
 
 
+    @staticmethod
+    def _may_have_artcom(info: base.InfoType) -> bool:
+        return not (
+            " commentary "         not in f" {info['tag_string_meta']} " and
+            " commentary_request " not in f" {info['tag_string_meta']} " and
+            pend.parse(info["created_at"]) > pend.yesterday()
+        )
+
+
     def artcom(self, info: base.InfoType) -> base.ArtcomType:
-        if " commentary "         not in f" {info['tag_string_meta']} " and \
-           " commentary_request " not in f" {info['tag_string_meta']} " and \
-            pend.parse(info["created_at"]) > pend.yesterday():
+        if not self._may_have_artcom(info):
             return []
 
         return self._api("artist_commentaries.json",
@@ -205,10 +481,173 @@ class Danbooru(net.NetClient):
         return self._api("notes.json", **{"search[post_id]": info["id"]})
 
 
+    def ordered_search(self, tags: str, by: str, descending: bool
+                      ) -> Optional[str]:
+        terms = tags.split()
+
+        if by not in ORDERS or len(terms) >= self.tag_limit or \
+           any(t.lstrip("-~").startswith("order:") for t in terms):
+            return None
+
+        return " ".join((*terms, f"order:{ORDERS[by][descending]}"))
+
+
     def count_posts(self, tags: str = "") -> int:
         return self._api("counts/posts.json", tags=tags)["counts"]["posts"]
 
 
+    # Async versions of the methods above, see aionet for requirements.
+
+    async def _api_async(self,
+                         endpoint_url: str,
+                         _catch_errs:  bool = True,
+                         **params) -> Union[None, Any]:
+        body = await self.http_async(
+            "get",
+            f"{self.site_url}/{endpoint_url}",
+            params = params,
+            auth   = self._auth
+        )
+
+        try:
+            if body is None:
+                raise AttributeError("No response")
+
+            return simplejson.loads(body)
+
+        except AttributeError:
+            if not _catch_errs:
+                raise
+            return []
+        except ValueError as err:
+            if not _catch_errs:
+                raise
+            LOG.error(str(err))
+            return []
+
+
+    async def info_id_async(self, post_id: int) -> Optional[base.InfoType]:
+        info = await self._api_async(f"posts/{post_id}.json")
+        return None if info and "id" not in info else info
+
+
+    async def info_md5_async(self, md5: str) -> base.AsyncInfoGenType:
+        for info in await self._api_async(f"posts.json", md5=md5):
+            if "id" in info:
+                yield info
+
+
+    async def info_search_async(self,
+                                tags:   str           = "",
+                                pages:  base.PageType = 1,
+                                limit:  Optional[int] = None,
+                                random: bool          = False,
+                                raw:    bool          = False,
+                                **kwargs) -> base.AsyncInfoGenType:
+
+        if re.match(r"^id:\d+$", tags):
+            post_id = fast_int(tags.split(":")[1], raise_on_invalid=True)
+            LOG.info("Fetching post %d", post_id)
+            info = await self.info_id_async(post_id)
+            if info:
+                yield info
+            return
+
+        if re.match(r"^md5:[a-fA-F\d]+$", tags):
+            LOG.info("Fetching post with MD5 %r", tags.split(":")[1])
+            async for info in self.info_md5_async(tags.split(":")[1]):
+                yield info
+            return
+
+        params = self._search_params(tags, limit, random, raw)
+        total  = await self.count_posts_async(params["tags"])
+        plan   = self._search_plan(params, pages, limit, total)
+
+        if plan:
+            async for info in self._fetch_pages_async(plan):
+                yield info
+
+
+    async def _fetch_pages_async(self, plan: _Pages
+                                ) -> base.AsyncInfoGenType:
+        requests = iter(plan.next_request, None)
+        pending: Deque[asyncio.Future] = collections.deque()
+
+        def request(params: Dict[str, Any]) -> None:
+            pending.append(
+                asyncio.ensure_future(self._search_page_async(params))
+            )
+
+        try:
+            for params in itertools.islice(requests, plan.ahead):
+                request(params)
+
+            while pending:
+                infos = plan.got(await pending.popleft())
+
+                if infos is None:
+                    return
+
+                for params in itertools.islice(requests, 1):
+                    request(params)
+
+                for info in infos:
+                    yield info
+
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+    async def _search_page_async(self, params: Dict[str, Any]
+                                ) -> Optional[List[base.InfoType]]:
+        try:
+            search = await self._api_async("posts.json", **params,
+                                           _catch_errs=False)
+            return [info for info in search if "id" in info]
+        except AttributeError:
+            return None
+        except ValueError as err:
+            LOG.error(str(err))
+            return None
+
+
+    async def artcom_async(self, info: base.InfoType) -> base.ArtcomType:
+        if not self._may_have_artcom(info):
+            return []
+
+        return await self._api_async("artist_commentaries.json",
+                                     **{"search[post_id]": info["id"]})
+
+
+    async def media_async(self, info: base.InfoType
+                         ) -> AsyncGenerator[bytes, None]:
+        "Yield chunks of the post's media, nothing if it is unavailable."
+
+        if "file_ext" not in info:
+            LOG.warning("No media available for post %d.", info["id"])
+            return
+
+        url_key = "large_file_url" if info["file_ext"] == "zip" else "file_url"
+
+        async for chunk in self.aio.stream("get", info[url_key],
+                                           chunk_size=8 * 1024 ** 2):
+            yield chunk
+
+
+    async def notes_async(self, info: base.InfoType) -> base.NotesType:
+        if not bool(info["last_noted_at"]):
+            return []
+
+        return await self._api_async("notes.json",
+                                     **{"search[post_id]": info["id"]})
+
+
+    async def count_posts_async(self, tags: str = "") -> int:
+        counts = await self._api_async("counts/posts.json", tags=tags)
+        return counts["counts"]["posts"]
+
+
     def get_location(self, info: base.InfoType, resource: str = "post", **_
                     ) -> Optional[str]:
         assert resource in ("post", "artcom", "info", "media", "notes")
@@ -0,0 +1,264 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+"""On-disk cache for booru API responses, used by NetClient.http().
+
+Responses are kept for a time depending on their endpoint (see TTLS).
+When that time is over, they are revalidated with the server using their
+ETag/Last-Modified headers if possible, instead of being downloaded again.
+The least recently used responses are removed when the cache gets bigger
+than its max size."""
+
+import hashlib
+import os
+import pickle
+import re
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Pattern, Tuple
+
+from appdirs import user_cache_dir
+from atomicfile import AtomicFile
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from .. import LOG, __about__
+
+FORMAT_VERSION = 1
+
+DIR      = Path(user_cache_dir(__about__.__project_name__)) / "http"
+MAX_SIZE = 256 * 1024 ** 2
+
+# Seconds for which responses are used without asking the server,
+# by URL path. Responses for other URLs are never cached.
+TTLS: Tuple[Tuple[Pattern, int], ...] = (
+    (re.compile(r"/counts/posts\.json$"),         10 * 60),
+    (re.compile(r"/posts\.json$"),                5 * 60),
+    (re.compile(r"/posts/\d+\.json$"),            60 * 60),
+    (re.compile(r"/notes\.json$"),                60 * 60),
+    (re.compile(r"/artist_commentaries\.json$"),  60 * 60),
+)
+
+# use:     return fresh responses, revalidate or fetch stale/missing ones
+# refresh: revalidate or fetch responses even if they are fresh
+# bypass:  don't read or save anything from/to the cache
+MODES = ("use", "refresh", "bypass")
+
+KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+SendType = Callable[..., Optional[Response]]
+
+
+class HttpCache:
+    def __init__(self,
+                 path:     Path = DIR,
+                 max_size: int  = MAX_SIZE,
+                 mode:     str  = "use") -> None:
+        self.path:     Path = path
+        self.max_size: int  = max_size
+        self.mode:     str  = mode
+
+        self._size: Optional[int] = None  # Computed on first save
+        self._lock: Lock          = Lock()
+
+
+    @staticmethod
+    def ttl(url: str, params: Optional[Dict[str, Any]] = None
+           ) -> Optional[int]:
+        "Return how long a response can be kept, None if it can't be cached."
+        if params and str(params.get("random", "")).lower() == "true":
+            return None
+
+        for regex, ttl in TTLS:
+            if regex.search(url.split("?", 1)[0]):
+                return ttl
+
+        return None
+
+
+    @staticmethod
+    def key(url: str, params: Optional[Dict[str, Any]] = None,
+            auth: Optional[Tuple[str, str]] = None) -> str:
+        # Results can differ between accounts, e.g. for premium-only tags
+        user   = auth[0] if auth else None
+        params = sorted((str(k), str(v)) for k, v in (params or {}).items())
+        return hashlib.sha1(repr((url, params, user)).encode()).hexdigest()
+
+
+    def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self.path / key
+
+        try:
+            with open(path, "rb") as file:
+                entry = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError) as err:
+            LOG.error("Ignoring corrupted cached response %r: %s",
+                      str(path), err)
+            return None
+
+        if entry.get("format") != FORMAT_VERSION:
+            return None
+
+        # Mark as recently used for eviction
+        try:
+            path.touch()
+        except OSError:
+            pass
+
+        return entry
+
+
+    def _save(self, key: str, entry: Dict[str, Any]) -> None:
+        path = self.path / key
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            old_size = path.stat().st_size if path.exists() else 0
+
+            with AtomicFile(path, "wb") as file:
+                pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            new_size = path.stat().st_size
+        except OSError as err:
+            LOG.error("Could not cache response: %s", err)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(stat.st_size for _, stat in self._stats())
+            else:
+                self._size += new_size - old_size
+
+            if self._size > self.max_size:
+                self._evict()
+
+
+    def _stats(self) -> List[Tuple[Path, os.stat_result]]:
+        "Return saved responses and their stats."
+        stats = []
+
+        # Other threads can be replacing files while we list them
+        for path in self.path.iterdir():
+            try:
+                stats.append((path, path.stat()))
+            except FileNotFoundError:
+                pass
+
+        return stats
+
+
+    def _evict(self) -> None:
+        "Remove least recently used responses, to 3/4 of the max size."
+        stats = self._stats()
+        stats.sort(key=lambda ps: ps[1].st_mtime)
+        self._size = sum(stat.st_size for _, stat in stats)
+
+        for path, stat in stats:
+            if self._size <= self.max_size * 3 // 4:
+                break
+
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+            self._size -= stat.st_size
+
+
+    def clear(self) -> None:
+        with self._lock:
+            if self.path.exists():
+                for path in self.path.iterdir():
+                    path.unlink()
+
+            self._size = 0
+
+
+    @staticmethod
+    def _response(entry: Dict[str, Any]) -> Response:
+        response             = Response()
+        response.status_code = 200
+        response.reason      = "OK"
+        response.url         = entry["url"]
+        response.headers     = CaseInsensitiveDict(entry["headers"])
+        response.encoding    = entry["encoding"]
+        response._content    = entry["content"]  # pylint: disable=W0212
+        return response
+
+
+    def _store(self, key: str, response: Response) -> None:
+        self._save(key, {
+            "format":   FORMAT_VERSION,
+            "url":      response.url,
+            "headers":  {h: response.headers[h]
+                         for h in KEPT_HEADERS if h in response.headers},
+            "encoding": response.encoding,
+            "content":  response.content,
+            "time":     time.time(),
+        })
+
+
+    def get(self, send: SendType, url: str, mode: Optional[str] = None,
+            **request_kwargs) -> Optional[Response]:
+        """Return a cached response for a GET request or send it.
+
+        `send(**request_kwargs)` must make the request, and return
+        None if it failed. `mode` is one of MODES, default is self.mode."""
+
+        mode   = mode or self.mode
+        params = request_kwargs.get("params")
+        ttl    = self.ttl(url, params)
+
+        if mode not in MODES:
+            raise ValueError(f"Cache mode must be in {MODES}, not {mode!r}")
+
+        if mode == "bypass" or ttl is None:
+            return send(**request_kwargs)
+
+        key   = self.key(url, params, request_kwargs.get("auth"))
+        entry = self._load(key)
+
+        if entry and mode == "use" and time.time() - entry["time"] < ttl:
+            return self._response(entry)
+
+        if entry:
+            headers = dict(request_kwargs.get("headers") or {})
+
+            if "ETag" in entry["headers"]:
+                headers["If-None-Match"] = entry["headers"]["ETag"]
+
+            if "Last-Modified" in entry["headers"]:
+                headers["If-Modified-Since"] = \
+                    entry["headers"]["Last-Modified"]
+
+            request_kwargs["headers"] = headers
+
+        response = send(**request_kwargs)
+
+        if response is None:
+            return None
+
+        if response.status_code == 304 and entry:
+            entry["time"] = time.time()
+            self._save(key, entry)
+            return self._response(entry)
+
+        if response.status_code == 200:
+            self._store(key, response)
+
+        return response
+
+
+SHARED: Optional[HttpCache] = None
+
+def shared() -> HttpCache:
+    "Return the cache used by clients that don't have their own."
+    global SHARED  # pylint: disable=global-statement
+
+    if SHARED is None:
+        SHARED = HttpCache()
+
+    return SHARED
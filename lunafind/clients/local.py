@@ -3,14 +3,25 @@
 
 import collections
 import csv
+import functools
+import io
+import itertools
 import math
 import multiprocessing as mp
 import os
+import pickle
+import time
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from typing import Callable, Generator, List, Optional, Sequence, Union
+from random import Random
+from threading import RLock
+from typing import (
+    Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional,
+    Sequence, Set, Tuple, Union
+)
 
 import simplejson
+import whratio
 from atomicfile import AtomicFile
 from dataclasses import dataclass, field
 
@@ -18,9 +29,13 @@ from dataclasses import dataclass, field
 from fastnumbers import fast_int
 
 from . import base
-from .. import LOG, order
-from ..filtering import filter_all
+from .. import LOG, utils
+from ..filtering import TagTerm, compile_query, filter_all, parse_terms
 from .base import InfoType
+from .columnar import ColumnarIndex, ColumnarInfo
+from .matches import MatchList
+from .md5index import Md5Index
+from .tagindex import POST_ID_MASK, StatType, TagIndex, file_stat, post_key
 
 
 def str2bool(string: str) -> Union[bool, str, None]:
@@ -100,25 +115,134 @@ POST_FIELDS = collections.OrderedDict({
 })
 
 
-_INDEXED_INFO_NT = collections.namedtuple("IndexedInfo", POST_FIELDS.keys())
+# Fields with few distinct values, stored as codes in the columnar index
+INTERNED_FIELDS = {"fetched_from", "file_ext", "rating", "uploader_name"}
 
-class IndexedInfo(_INDEXED_INFO_NT):
-    _row_converts: List[Callable] = POST_FIELDS.values()
+COLUMN_KINDS = collections.OrderedDict(
+    (key, "int"    if conv is str2int         else
+          "bool"   if conv is str2bool        else
+          "intern" if key in INTERNED_FIELDS  else "str")
+    for key, conv in POST_FIELDS.items()
+)
+
+STATE_VERSION = 1
+
+# Use a process pool to index posts when there are at least this many
+PROCESS_POOL_MIN_POSTS = 2000
+
+ID_IDX   = list(POST_FIELDS.keys()).index("id")
+FROM_IDX = list(POST_FIELDS.keys()).index("fetched_from")
+TAGS_IDX = list(POST_FIELDS.keys()).index("tag_string")
+MD5_IDX  = list(POST_FIELDS.keys()).index("md5")
+
+# Posts filtered at once when NumPy is available, see filter_all()
+FILTER_BATCH_SIZE = 1024
+
+# Read rows directly from the columnar index for searches resolving to
+# less posts than the index has rows divided by this
+ROWS_LOOKUP_RATIO = 64
+
+
+# Field name: (index in a row, converter)
+_ROW_FIELDS = {key: (i, conv)
+               for i, (key, conv) in enumerate(POST_FIELDS.items())}
+
+
+def dirname_key(dirname: str) -> int:
+    "Return the post key for a post directory name, e.g. danbooru-1."
+    booru, post_id = dirname.rsplit("-", 1)
+    return post_key(booru, fast_int(post_id, -1))
+
+
+def _field(row: Sequence[str], key: str) -> str:
+    return row[_ROW_FIELDS[key][0]]
+
+
+def _epoch(key: str) -> Callable[[Sequence[str]], Optional[int]]:
+    return lambda row: utils.iso2epoch(_field(row, key))
+
+
+# Values computed when building the columnar index, used by filtering and
+# ordering instead of recomputing them for every post.
+# Dates are stored in microseconds since the epoch.
+DERIVED_FIELDS = collections.OrderedDict({
+    "mpixels": ("float", lambda r: fast_int(_field(r, "image_width"),  0) *
+                                   fast_int(_field(r, "image_height"), 0) /
+                                   1_000_000),
+
+    "ratio": ("float", lambda r: whratio.as_float(
+        fast_int(_field(r, "image_width"),  1),
+        fast_int(_field(r, "image_height"), 1),
+    )),
+
+    "child_count": ("int", lambda r: len(_field(r, "children_ids").split())),
+
+    "created_at_epoch": ("int", _epoch("created_at")),
+    "fetched_at_epoch": ("int", _epoch("fetched_at")),
+    "updated_at_epoch": ("int", _epoch("updated_at")),
+})
+
+
+class IndexedInfo(base.LazyInfo):
+    "Post info from an index.tsv row, fields are converted on first access."
+
+    __slots__ = ("_row",)
+
+    def __init__(self, row: Sequence[str]) -> None:
+        if len(row) < len(POST_FIELDS):
+            raise TypeError(f"Expected {len(POST_FIELDS)} fields in row, "
+                            f"got {len(row)}.")
+        super().__init__()
+        self._row = row
 
 
     @classmethod
     def from_csv(cls, row: Sequence[str]) -> "IndexedInfo":
-        return cls(*(c(v) for c, v in zip(cls._row_converts, row)))
+        return cls(row)
+
 
+    def keys(self) -> Iterable[str]:
+        return POST_FIELDS.keys()
 
-    def __getitem__(self, key):
-        if isinstance(key, str):
-            return getattr(self, key)
-        return tuple(self)[key]
 
+    def _load(self, key: str) -> Any:
+        index, convert = _ROW_FIELDS[key]
+        return convert(self._row[index])
 
-    def __contains__(self, key: str):
-        return hasattr(self, key)
+
+# (post ID, TSV line, post key, tag string, md5, post dirname)
+IndexRowType = Tuple[int, str, int, str, str, str]
+
+def read_index_rows(root: Path, post_dirnames: List[str]
+                   ) -> Tuple[List[IndexRowType], List[str]]:
+    "Read info.json of post dirs, return index rows and error messages."
+
+    rows, errors = [], []
+    buffer       = io.StringIO()
+    writer       = csv.DictWriter(buffer,
+                                  delimiter    = "\t",
+                                  fieldnames   = POST_FIELDS.keys(),
+                                  extrasaction = "ignore")
+
+    for dirname in post_dirnames:
+        try:
+            with open(root / dirname / "info.json", "r") as file:
+                info = simplejson.loads(file.read())
+        except (FileNotFoundError, NotADirectoryError) as err:
+            errors.append(str(err))
+            continue
+        except ValueError as err:
+            errors.append(f"{dirname}: invalid info.json: {err}")
+            continue
+
+        writer.writerow(info)
+        rows.append((info["id"], buffer.getvalue(),
+                     post_key(info["fetched_from"], info["id"]),
+                     info["tag_string"], info.get("md5") or "", dirname))
+        buffer.seek(0)
+        buffer.truncate()
+
+    return (rows, errors)
 
 
 @dataclass
@@ -126,22 +250,254 @@ class Local(base.Client):
     name: str              = "local"
     path: Union[Path, str] = Path(".")
 
-    index: Path = field(init=False, default=None, repr=False)
+    # Search through the columnar index instead of parsing index.tsv
+    columnar: bool = True
+    # Processes used to index new posts. If None, use one per CPU when
+    # there are many posts to index. If 1, only use threads.
+    index_processes: Optional[int] = None
+    # Seed for random searches, set to get the same results for each search
+    random_seed: Optional[int] = None
+
+    index:     Path = field(init=False, default=None, repr=False)
+    index_dir: Path = field(init=False, default=None, repr=False)
+    tag_index: Path = field(init=False, default=None, repr=False)
+    md5_index: Path = field(init=False, default=None, repr=False)
+    columns:   Path = field(init=False, default=None, repr=False)
+    state:     Path = field(init=False, default=None, repr=False)
+    matches:   Path = field(init=False, default=None, repr=False)
+
+    _state: Optional[dict] = field(init=False, default=None, repr=False)
+
+    _matches: Dict[str, MatchList] = \
+        field(init=False, default_factory=dict, repr=False)
+
+    _counts:        Dict[str, int]     = \
+        field(init=False, default_factory=dict, repr=False)
+    _counts_source: Optional[StatType] = \
+        field(init=False, default=None, repr=False)
+
+    _tag_index: Optional[TagIndex] = \
+        field(init=False, default=None, repr=False)
+
+    _md5_index: Optional[Md5Index] = \
+        field(init=False, default=None, repr=False)
+
+    _columns: Optional[ColumnarIndex] = \
+        field(init=False, default=None, repr=False)
+
+    # For searches running in several threads, e.g. from AsyncStream
+    _lock: RLock = field(init=False, default_factory=RLock, repr=False)
 
 
     def __post_init__(self) -> None:
-        self.path  = Path(self.path or ".").expanduser()
-        self.index = self.path / "index.tsv"
+        self.path      = Path(self.path or ".").expanduser()
+        self.index     = self.path / "index.tsv"
+        # Files derived from index.tsv, kept in a sub directory to not
+        # modify the posts directory's mtime when they're updated.
+        self.index_dir = self.path / "index.d"
+        self.tag_index = self.index_dir / "tags"
+        self.md5_index = self.index_dir / "md5"
+        self.columns   = self.index_dir / "columns"
+        self.state     = self.index_dir / "state"
+        self.matches   = self.index_dir / "matches"
+
+
+    @property
+    def index_files(self) -> Set[str]:
+        "Names of files in the post directory that aren't posts."
+        return {self.index.name, self.index_dir.name}
+
+
+    def _get_tag_index(self) -> TagIndex:
+        with self._lock:
+            return self._load_tag_index()
+
+
+    def _load_tag_index(self) -> TagIndex:
+        source = file_stat(self.index)
+
+        if self._tag_index and self._tag_index.source == source:
+            return self._tag_index
+
+        self._tag_index = TagIndex.load(self.tag_index, source)
+
+        if self._tag_index:
+            return self._tag_index
+
+        LOG.info("Building tag index...")
+        self.index_dir.mkdir(exist_ok=True)
+
+        with open(self.index, "r", newline="") as file:
+            self._tag_index = TagIndex.build(self.tag_index, (
+                (post_key(row[FROM_IDX], fast_int(row[ID_IDX], -1)),
+                 row[TAGS_IDX])
+                for row in csv.reader(file, delimiter="\t")
+                if len(row) >= len(POST_FIELDS)
+            ))
+
+        self._tag_index.save(source)
+        return self._tag_index
+
+
+    def _get_md5_index(self) -> Md5Index:
+        with self._lock:
+            return self._load_md5_index()
+
+
+    def _load_md5_index(self) -> Md5Index:
+        source = file_stat(self.index)
+
+        if self._md5_index and self._md5_index.source == source:
+            return self._md5_index
+
+        self._md5_index = Md5Index.load(self.md5_index, source)
+
+        if self._md5_index:
+            return self._md5_index
+
+        LOG.info("Building MD5 index...")
+        self.index_dir.mkdir(exist_ok=True)
+
+        with open(self.index, "r", newline="") as file:
+            self._md5_index = Md5Index.build(self.md5_index, (
+                (row[MD5_IDX], f"{row[FROM_IDX]}-{row[ID_IDX]}")
+                for row in csv.reader(file, delimiter="\t")
+                if len(row) >= len(POST_FIELDS)
+            ))
+
+        self._md5_index.save(source)
+        return self._md5_index
 
 
-    def _get_info(self, post_dirname: str) ->  base.InfoType:
-        path = self.path / post_dirname / "info.json"
-        with open(path, "r") as file:
-            return simplejson.loads(file.read())
+    def _get_columns(self) -> ColumnarIndex:
+        with self._lock:
+            return self._load_columns()
 
 
-    def _index_add(self, post_dirnames: List[str]) -> base.InfoGenType:
-        LOG.info("Indexing %d posts...", len(post_dirnames))
+    def _load_columns(self) -> ColumnarIndex:
+        source = file_stat(self.index)
+
+        if self._columns and self._columns.source == source:
+            return self._columns
+
+        # Previously returned infos keep a reference to the old index,
+        # so it is not explicitly closed here. Rebuilding writes new files
+        # instead of replacing its mapped ones, see ColumnarIndex.
+        self._columns = ColumnarIndex.open(self.columns, source)
+
+        if self._columns:
+            return self._columns
+
+        LOG.info("Building columnar index...")
+        self.index_dir.mkdir(exist_ok=True)
+
+        with open(self.index, "r", newline="") as file:
+            bad_rows = ColumnarIndex.build(
+                self.columns,
+                COLUMN_KINDS,
+                csv.reader(file, delimiter="\t"),
+                source,
+                DERIVED_FIELDS,
+            )
+
+        if bad_rows:
+            LOG.error("Corrupted posts in index on lines %s, will try to "
+                      "repair.", ", ".join(str(r) for r in bad_rows))
+            self._index_del(*bad_rows)
+            return self._get_columns()
+
+        self._columns = ColumnarIndex(self.columns)
+        return self._columns
+
+
+    @staticmethod
+    def _plain_tags(tags: str, raw: bool = False
+                   ) -> Tuple[List[str], List[str], List[str], bool]:
+        """Return the (required, excluded, any_of) plain tags of a search,
+        and whether these are all the terms of the search."""
+
+        simple, meta_num, meta_str = parse_terms(tags, raw)
+
+        plain    = [t for t in simple if "*" not in t]
+        required = [t        for t in plain if t[0] not in ("-", "~")]
+        excluded = [t[1:]    for t in plain if t[0] == "-"]
+        any_of   = [t[1:]    for t in plain if t[0] == "~"]
+
+        # "~" terms form a single OR group, only usable if it's all plain tags
+        all_tilde = [t for t in simple | meta_num | meta_str if t[0] == "~"]
+        if len(all_tilde) != len(any_of):
+            any_of = []
+
+        only_plain = len(plain) == len(simple) and not (meta_num or meta_str)
+        return (required, excluded, any_of, only_plain)
+
+
+    def _resolve_tags(self,
+                      tags:         str,
+                      raw:          bool = False,
+                      partial_tags: bool = False,
+                     ) -> Tuple[Optional[Set[int]], Set[int]]:
+        """Return (post keys to include, keys to exclude) from the tag and
+        MD5 indexes.
+
+        Wildcard tags are expanded to the matching tags of the index.
+        The result can include posts not matching other search terms."""
+
+        query = compile_query(tags, raw, partial_tags)
+
+        # Tag terms, ignoring "*" which matches any post with tags
+        tag_terms = lambda terms: [t.tag for t in terms
+                                   if isinstance(t, TagTerm) and
+                                   t.tag.strip("*")]
+
+        required = tag_terms(query.required)
+        excluded = tag_terms(query.excluded)
+        any_of   = tag_terms(query.any_of)
+
+        # "~" terms form a single OR group, only usable if it's all tags
+        if len(any_of) != len(query.any_of):
+            any_of = []
+
+        md5s = {t.text[len("md5:"):] for t in query.required
+                if t.text.startswith("md5:")}
+
+        if not (required or excluded or any_of or md5s) or \
+           not self.index.exists():
+            return (None, set())
+
+        index  = self._get_tag_index()
+        expand = lambda tags: {m for t in tags for m in index.expand(t)}
+
+        # Wildcards are expanded over all tags, which refresh() can update
+        with self._lock:
+            excluded     = expand(excluded)
+            any_of       = expand(any_of)
+            required_any = [index.expand(t) for t in required if "*" in t]
+
+        include, exclude = index.resolve(
+            required     = [t for t in required if "*" not in t],
+            excluded     = excluded,
+            any_of       = any_of,
+            required_any = required_any,
+        )
+
+        for md5 in md5s:
+            keys    = {dirname_key(d) for d in self._get_md5_index().get(md5)}
+            include = keys - exclude if include is None else include & keys
+            exclude = set()
+
+        return (include, exclude)
+
+
+    def tag_frequencies(self, tags: Iterable[str]) -> Dict[str, float]:
+        if not self.index.exists():
+            return {}
+        return self._get_tag_index().frequencies(tags)
+
+
+    def _index_add(self, post_dirnames: List[str]) -> int:
+        total = len(post_dirnames)
+        LOG.info("Indexing %d posts...", total)
 
         post_dirnames.sort(key     = lambda d: fast_int(d.split("-")[-1], -1),
                            reverse = True)
@@ -149,117 +505,331 @@ class Local(base.Client):
         if not self.index.exists():
             self.index.write_text("")
 
-        with open      (self.index, "r", newline="") as in_file, \
-             AtomicFile(self.index, "w")             as out_file:
+        tag_index = self._get_tag_index()
+        md5_index = self._get_md5_index()
+        added     = []
 
-            # Not just using csv.DictReader for performance reasons
-            id_idx = list(POST_FIELDS.keys()).index("id")
-            reader = csv.reader(in_file, delimiter="\t")
+        processes = self.index_processes
+        if processes is None:
+            processes = mp.cpu_count() if total >= PROCESS_POOL_MIN_POSTS \
+                        else 1
 
-            src_row_writer = csv.writer(out_file, delimiter="\t")
-            new_info_writer = csv.DictWriter(
-                out_file,
-                delimiter    = "\t",
-                fieldnames   = POST_FIELDS.keys(),
-                extrasaction = "ignore"
-            )
+        # Threads are enough when JSON parsing isn't the bottleneck
+        workers = processes if processes > 1 else mp.cpu_count() * 5
+        pool    = mp.Pool(workers) if processes > 1 else ThreadPool(workers)
 
-            pool  = ThreadPool(mp.cpu_count() * 5)
-            tasks = [pool.apply_async(self._get_info, (p,))
-                     for p in post_dirnames]
+        chunk_size = max(16, math.ceil(total / (workers * 8)))
+        chunks     = [post_dirnames[i:i + chunk_size]
+                      for i in range(0, total, chunk_size)]
 
-            def info_gen():
-                for task in tasks:
-                    try:
-                        yield task.get()
-                    except (FileNotFoundError, NotADirectoryError) as err:
-                        if str(err.filename) != self.index.name:
-                            LOG.error(str(err))
+        def new_rows_gen() -> Generator[IndexRowType, None, None]:
+            start = last_report = time.monotonic()
+            done  = 0
 
-            info_gen = info_gen()
-            try:
-                new_info = next(info_gen)
-            except StopIteration:
-                return
+            # imap: chunks are returned in order, so rows stay sorted by ID
+            for rows, errors in pool.imap(
+                functools.partial(read_index_rows, self.path), chunks
+            ):
+                for error in errors:
+                    LOG.error(error)
+
+                yield from rows
+
+                done += len(rows) + len(errors)
+                now   = time.monotonic()
 
-            no_more_to_add = False
+                if now - last_report >= 5 and done < total:
+                    LOG.info("Indexed %d/%d posts (%d posts/s)...",
+                             done, total, done / (now - start))
+                    last_report = now
+
+            elapsed = time.monotonic() - start
+            LOG.info("Indexed %d posts in %.1fs (%d posts/s).",
+                     done, elapsed, done / max(elapsed, 0.001))
+
+        with pool, \
+             open      (self.index, "r", newline="") as in_file, \
+             AtomicFile(self.index, "w")             as out_file:
+
+            # Not just using csv.DictReader for performance reasons
+            reader         = csv.reader(in_file, delimiter="\t")
+            src_row_writer = csv.writer(out_file, delimiter="\t")
+            new_rows       = new_rows_gen()
+            new_row        = next(new_rows, None)
+
+            def write_new_row() -> Optional[IndexRowType]:
+                out_file.write(new_row[1])
+                added.append(new_row)
+                return next(new_rows, None)
 
             for source_row in reader:
                 try:
-                    src_id = fast_int(source_row[id_idx],raise_on_invalid=True)
+                    src_id = fast_int(source_row[ID_IDX],raise_on_invalid=True)
                 except ValueError:
                     LOG.error("Removing invalid row in index: %r", source_row)
                     continue
 
-                while not no_more_to_add and new_info["id"] > src_id:
-                    new_info_writer.writerow(new_info)
-                    yield new_info
-
-                    try:
-                        new_info = next(info_gen)
-                    except StopIteration:
-                        no_more_to_add = True
+                while new_row and new_row[0] > src_id:
+                    new_row = write_new_row()
 
                 src_row_writer.writerow(source_row)
 
-            if not no_more_to_add:
-                new_info_writer.writerow(new_info)
-                yield new_info
+            while new_row:
+                new_row = write_new_row()
 
-            for remaining_info in info_gen:
-                new_info_writer.writerow(remaining_info)
-                yield remaining_info
+        tag_index.update(added=((r[2], r[3]) for r in added))
+        tag_index.save(file_stat(self.index))
+        md5_index.update(added=((r[4], r[5]) for r in added))
+        md5_index.save(file_stat(self.index))
+        return len(added)
 
 
-    def _index_del(self, *line_nums: int) -> None:
-        LOG.info("Deleting from index %d post dirs...", len(line_nums))
+    def _index_del(self, *line_nums: int, dirnames: Set[str] = frozenset()
+                  ) -> None:
+        LOG.info("Deleting from index %d post dirs...",
+                 len(line_nums) + len(dirnames))
+
+        tag_index = self._get_tag_index()
+        md5_index = self._get_md5_index()
+        removed   = []
 
         with open      (self.index, "r", newline="") as in_file, \
              AtomicFile(self.index, "w")             as out_file:
 
             for i, line in enumerate(in_file, 1):
-                if i not in line_nums:
+                # id and fetched_from are the first fields, never quoted
+                fields  = line.split("\t", 2)
+                dirname = f"{fields[FROM_IDX]}-{fields[ID_IDX]}" \
+                          if len(fields) > 2 else None
+
+                if i not in line_nums and dirname not in dirnames:
                     out_file.write(line)
+                    continue
+
+                row = next(csv.reader([line], delimiter="\t"), [])
+                if len(row) >= len(POST_FIELDS):
+                    removed.append(row)
 
+        tag_index.update(removed=(
+            (post_key(r[FROM_IDX], fast_int(r[ID_IDX], -1)), r[TAGS_IDX])
+            for r in removed
+        ))
+        tag_index.save(file_stat(self.index))
 
-    def _index_iter(self, post_dirnames: List[str]
-                   ) -> Generator[IndexedInfo, None, None]:
+        md5_index.update(removed=(
+            (r[MD5_IDX], f"{r[FROM_IDX]}-{r[ID_IDX]}") for r in removed
+        ))
+        md5_index.save(file_stat(self.index))
+
+
+    def _load_state(self) -> Optional[dict]:
+        try:
+            with open(self.state, "rb") as file:
+                state = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError) as err:
+            LOG.error("Corrupted index state file, will rebuild: %s", err)
+            return None
+
+        if state.get("version") != STATE_VERSION or \
+           state.get("source") != file_stat(self.index):
+            return None
+
+        return state
+
+
+    def _save_state(self, root_mtime: Optional[int], dirs: Dict[str, int]
+                   ) -> None:
+        # Don't trust the root mtime if it could change again in the same
+        # timestamp tick on file systems with a coarse mtime resolution.
+        if root_mtime and time.time() - root_mtime / 1e9 < 2:
+            root_mtime = None
+
+        self._state = {"version": STATE_VERSION,
+                       "source":  file_stat(self.index),
+                       "root":    root_mtime,
+                       "dirs":    dirs}
+
+        with AtomicFile(self.state, "wb") as file:
+            pickle.dump(self._state, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def _indexed_dirnames(self) -> Dict[str, Optional[int]]:
+        if not self.index.exists():
+            return {}
+
+        if self.columnar:
+            cols   = self._get_columns()
+            ids    = cols.column("id").values
+            boorus = cols.column("fetched_from")
+            return {f"{boorus.strings[code]}-{post_id}": None
+                    for code, post_id in zip(boorus.values, ids)}
+
+        with open(self.index, "r", newline="") as file:
+            return {f"{row[FROM_IDX]}-{row[ID_IDX]}": None
+                    for row in csv.reader(file, delimiter="\t")
+                    if len(row) >= len(POST_FIELDS)}
+
+
+    def refresh(self, full: bool = False) -> "Local":
+        """Update the index for added and removed post directories.
+
+        The post directories are only listed if the root directory was
+        modified since the last refresh. If full is True, every post
+        directory is also checked for modifications, and changed posts are
+        indexed again."""
+
+        with self._lock:
+            return self._refresh(full)
+
+
+    def _refresh(self, full: bool) -> "Local":
+        self.index_dir.mkdir(exist_ok=True)
+
+        state      = self._state or self._load_state()
+        root_mtime = self.path.stat().st_mtime_ns
+        trusted    = state and state["source"] == file_stat(self.index)
+
+        if trusted and not full and state["root"] == root_mtime:
+            self._state = state
+            return self
+
+        with os.scandir(self.path) as entries:
+            names = {e.name for e in entries
+                     if e.is_dir() and e.name not in self.index_files}
+
+        if trusted:
+            known = state["dirs"]
+        else:
+            # Index modified by something else, find what's really in it
+            old_mtimes = state["dirs"] if state else {}
+            known      = {n: old_mtimes.get(n)
+                          for n in self._indexed_dirnames()}
+
+        added   = names - known.keys()
+        removed = known.keys() - names
+        changed = set()
+        mtimes  = {n: m for n, m in known.items() if n in names}
+
+        stat_names = names if full else added
+
+        for name in stat_names:
+            try:
+                mtime = (self.path / name).stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            if mtimes.get(name) not in (None, mtime):
+                changed.add(name)
+
+            mtimes[name] = mtime
+
+        if (removed or changed) and self.index.exists():
+            self._index_del(dirnames=removed | changed)
+
+        if added or changed:
+            self._index_add(list(added | changed))
+
+        # Rewriting index.tsv changed the root mtime, and a post dir could
+        # have been added since we listed them: check again next time.
+        modified = removed or added or changed
+        self._save_state(None if modified else root_mtime, mtimes)
+        return self
+
+
+    def _index_iter(self,
+                    include: Optional[Set[int]] = None,
+                    exclude: Set[int]           = frozenset(),
+                   ) -> Generator[base.LazyInfo, None, None]:
+
+        self.refresh()
 
         if not self.index.exists():
-            yield from self._index_add(post_dirnames)
             return
 
-        lines_to_del     = []
-        unfound_dirnames = set(post_dirnames)
-        unfound_dirnames.discard(self.index.name)
-        del post_dirnames
+        if self.columnar:
+            yield from self._columns_iter(include, exclude)
+        else:
+            yield from self._tsv_iter(include, exclude)
+
+
+    def _columns_iter(self,
+                      include: Optional[Set[int]] = None,
+                      exclude: Set[int]           = frozenset(),
+                      start:   int                = 0,
+                     ) -> Generator[ColumnarInfo, None, None]:
+
+        cols = self._get_columns()
+
+        if include is None and not exclude:
+            for row in range(start, len(cols)):
+                yield cols.info(row)
+            return
+
+        ids      = cols.column("id").values
+        boorus   = cols.column("fetched_from")
+        codes    = boorus.values
+        prefixes = [post_key(b, 0) for b in boorus.strings]
+
+        # Few posts wanted: find their rows by ID instead of checking all
+        if include is not None and \
+           len(include) * ROWS_LOOKUP_RATIO < len(cols) and \
+           cols.is_sorted("id", reverse=True):
+
+            rows = sorted(
+                row
+                for key in include
+                for row in cols.search_sorted("id", key & POST_ID_MASK,
+                                              reverse=True)
+                if row >= start and prefixes[codes[row]] | ids[row] == key
+            )
+
+            for row in rows:
+                if prefixes[codes[row]] | ids[row] not in exclude:
+                    yield cols.info(row)
+            return
+
+        for row in range(start, len(cols)):
+            key = prefixes[codes[row]] | ids[row]
+
+            if (include is not None and key not in include) or \
+               key in exclude:
+                continue
+
+            yield cols.info(row)
+
+
+    def _tsv_iter(self,
+                  include: Optional[Set[int]] = None,
+                  exclude: Set[int]           = frozenset(),
+                 ) -> Generator[IndexedInfo, None, None]:
+
+        lines_to_del = []
 
         with open(self.index, "r", newline="") as file:
             reader = csv.reader(file, delimiter="\t")
 
             for i, row in enumerate(reader, 1):
+                if (include is not None or exclude) and \
+                   len(row) >= len(POST_FIELDS):
+
+                    key = post_key(row[FROM_IDX], fast_int(row[ID_IDX], -1))
+
+                    if (include is not None and key not in include) or \
+                       key in exclude:
+                        continue
+
                 try:
-                    info = IndexedInfo.from_csv(row)
+                    yield IndexedInfo.from_csv(row)
                 except TypeError:
                     LOG.error("Corrupted post in index on line %d, "
                               "will try to repair: %r", i, row)
                     lines_to_del.append(i)
-                    continue
-
-                key  = f"{info.fetched_from}-{info.id}"
-
-                try:
-                    unfound_dirnames.remove(key)
-                except KeyError:
-                    lines_to_del.append(i)
-                else:
-                    yield info
 
         if lines_to_del:
-            self._index_del(*lines_to_del)
-
-        if unfound_dirnames:
-            yield from self._index_add(list(unfound_dirnames))
+            with self._lock:
+                self._index_del(*lines_to_del)
 
 
     def _get_post_path(self, info: InfoType) -> Path:
@@ -303,7 +873,72 @@ class Local(base.Client):
 
 
     def info_md5(self, md5: str) -> base.InfoGenType:
-        yield from self.info_search(f"md5:{md5}")
+        yield from self.info_md5s((md5,))
+
+
+    def info_md5s(self, md5s: Iterable[str]) -> base.InfoGenType:
+        self.refresh()
+
+        if not self.index.exists():
+            return
+
+        md5_index = self._get_md5_index()
+
+        for md5 in md5s:
+            for dirname in md5_index.get(md5.lower()):
+                try:
+                    yield simplejson.loads(
+                        (self.path / dirname / "info.json").read_text()
+                    )
+                except FileNotFoundError:
+                    continue
+
+
+    def _get_matches(self, tags: str, raw: bool, partial_tags: bool
+                    ) -> MatchList:
+        "Return the list of columnar index rows matching a search."
+
+        cols  = self._get_columns()
+        query = compile_query(tags, raw, partial_tags)
+        key   = MatchList.key(tags, raw, partial_tags)
+
+        def scan(start: int) -> Iterator[int]:
+            include, exclude = self._resolve_tags(tags, raw, partial_tags)
+
+            infos = filter_all(self._columns_iter(include, exclude, start),
+                               terms      = query,
+                               estimates  = self.tag_frequencies(query.tags),
+                               batch_size = FILTER_BATCH_SIZE)
+
+            for info in infos:
+                yield info.row
+
+        # Results of searches like age:<1w change with time, can't keep them
+        if query.time_relative:
+            return MatchList(scan)
+
+        with self._lock:
+            matches = self._matches.get(key)
+
+            if not matches or matches.version != cols.source:
+                self._matches[key] = matches = MatchList.load(
+                    scan, self.matches / key, cols.source
+                )
+
+        return matches
+
+
+    def _search_positions(self, pages: base.PageType, limit: Optional[int]
+                         ) -> Optional[List[int]]:
+        "Return sorted positions of the wanted results, None for all."
+
+        if not limit or limit in (-1, math.inf):
+            return None
+
+        last = math.ceil(len(self._state["dirs"]) / limit)
+        return sorted({i
+                       for p in self._parse_pages(pages, last)
+                       for i in range((p-1) * limit, (p-1) * limit + limit)})
 
 
     # pylint: disable=arguments-differ
@@ -313,33 +948,127 @@ class Local(base.Client):
                     limit:        Optional[int] = None,
                     random:       bool          = False,
                     raw:          bool          = False,
-                    partial_tags: bool          = False) -> base.InfoGenType:
+                    partial_tags: bool          = False,
+                    seed:         Optional[int] = None) -> base.InfoGenType:
 
-        posts = os.listdir(self.path)
+        self.refresh()
 
-        ok_i = max_i = None
-
-        if limit and limit not in (-1, math.inf):
-            last  = math.ceil(len(posts) / limit)
-            ok_i  = {i
-                     for p in self._parse_pages(pages, last)
-                     for i in range((p-1) * limit, (p-1) * limit + limit)}
-            max_i = sorted(ok_i)[-1]
+        if not self.index.exists():
+            return
 
-        posts = filter_all(self._index_iter(posts),
-                           terms=tags, raw=raw, partial_tags=partial_tags)
+        positions = self._search_positions(pages, limit)
 
         if random:
-            posts = iter(order.sort(list(posts), by="random"))
+            yield from self._random_search(
+                tags, positions, raw, partial_tags,
+                Random(self.random_seed if seed is None else seed)
+            )
+            return
+
+        if not self.columnar:
+            yield from self._scan_search(tags, positions, raw, partial_tags)
+            return
+
+        # Results are read from the columnar index by position: skip to the
+        # first wanted one directly, and stop after the last.
+        cols    = self._get_columns()
+        matches = None
+
+        if compile_query(tags, raw, partial_tags):
+            matches = self._get_matches(tags, raw, partial_tags)
+            row_at  = matches.__getitem__
+        else:
+            row_at  = lambda pos: pos if pos < len(cols) else None
+
+        try:
+            for position in itertools.count() if positions is None else \
+                            positions:
+                row = row_at(position)
+                if row is None:
+                    break
+                yield cols.info(row)
+        finally:
+            if matches is not None:
+                matches.save()
+
+
+    def _scan_search(self,
+                     tags:         str,
+                     positions:    Optional[List[int]],
+                     raw:          bool,
+                     partial_tags: bool) -> base.InfoGenType:
+
+        include, exclude = self._resolve_tags(tags, raw, partial_tags)
+
+        posts = filter_all(self._index_iter(include, exclude),
+                           terms        = tags,
+                           raw          = raw,
+                           partial_tags = partial_tags,
+                           batch_size   = FILTER_BATCH_SIZE)
+
+        if positions is None:
+            yield from posts
+            return
+
+        if not positions:
+            return
+
+        wanted = set(positions)
 
         for i, post in enumerate(posts):
-            if max_i and i > max_i:
+            if i > positions[-1]:
                 break
 
-            if ok_i and i not in ok_i:
-                continue
+            if i in wanted:
+                yield post
+
 
-            yield post
+    def _random_search(self,
+                       tags:         str,
+                       positions:    Optional[List[int]],
+                       raw:          bool,
+                       partial_tags: bool,
+                       rng:          Random) -> base.InfoGenType:
+
+        # Only the results up to the last wanted position need to be picked:
+        # a random sample in random order is the start of a random shuffle.
+        if positions == []:
+            return
+
+        wanted = None if positions is None else positions[-1] + 1
+
+        # Find all matching rows first, so that a seed picks the same posts
+        # whether the search results were saved before or not.
+        if self.columnar:
+            cols = self._get_columns()
+
+            if not compile_query(tags, raw, partial_tags):
+                rows: Sequence[int] = range(len(cols))
+            else:
+                matches = self._get_matches(tags, raw, partial_tags)
+                try:
+                    matches.count()
+                finally:
+                    matches.save()
+                rows = matches.rows
+
+            picked = rng.sample(range(len(rows)),
+                                min(wanted or len(rows), len(rows)))
+            chosen = [cols.info(rows[i]) for i in picked]
+        else:
+            posts  = self._scan_search(tags, None, raw, partial_tags)
+            chosen = list(posts) if wanted is None else \
+                     utils.reservoir_sample(posts, wanted, rng)
+            rng.shuffle(chosen)
+
+        if positions is None:
+            yield from chosen
+            return
+
+        for i in positions:
+            if i >= len(chosen):
+                break
+            yield chosen[i]
 
 
     def info_location(self, location: Union[str, Path]) -> base.InfoGenType:
@@ -387,7 +1116,38 @@ class Local(base.Client):
 
 
     def count_posts(self, tags: str = "") -> int:
-        return len(list(self.info_search(tags)))
+        self.refresh()
+
+        if not self.index.exists():
+            return 0
+
+        source = file_stat(self.index)
+
+        if source != self._counts_source:
+            self._counts, self._counts_source = {}, source
+
+        try:
+            return self._counts[tags]
+        except KeyError:
+            pass
+
+        required, excluded, any_of, only_plain = self._plain_tags(tags)
+
+        if only_plain:
+            count = self._get_tag_index().count(required, excluded, any_of)
+
+        elif self.columnar:
+            matches = self._get_matches(tags, False, False)
+            count   = matches.count()
+            matches.save()
+
+        else:
+            count = sum(1 for _ in self._scan_search(tags, None, False, False))
+
+        if not compile_query(tags).time_relative:
+            self._counts[tags] = count
+
+        return count
 
 
     def get_location(self,
@@ -0,0 +1,150 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+"Cached lists of index rows matching local searches."
+
+import hashlib
+import pickle
+from array import array
+from pathlib import Path
+from threading import RLock
+from typing import Callable, Iterator, Optional
+
+from atomicfile import AtomicFile
+
+from .. import LOG
+
+FORMAT_VERSION = 1
+
+# Max number of match lists kept on disk
+MAX_SAVED = 64
+
+ScanType = Callable[[int], Iterator[int]]
+
+
+class MatchList:
+    """Rows of an index matching a search, found so far.
+
+    Rows are found on demand by scanning the index, starting after the
+    last row examined by previous uses of the list, and can be saved to
+    let future searches for the same terms skip directly to any result.
+    Lists can be used by several threads at once."""
+
+    def __init__(self,
+                 scan:    ScanType,
+                 path:    Optional[Path] = None,
+                 version: tuple          = ()) -> None:
+        self.scan:     ScanType       = scan
+        self.path:     Optional[Path] = path
+        self.version:  tuple          = version
+        self.rows:     array          = array("q")
+        self.scanned:  int            = 0  # Index rows examined so far
+        self.complete: bool           = False
+
+        self._scanner:  Optional[Iterator[int]] = None
+        self._modified: bool                    = False
+        self._lock:     RLock                   = RLock()
+
+
+    @staticmethod
+    def key(*search_args) -> str:
+        return hashlib.sha1(repr(search_args).encode()).hexdigest()
+
+
+    @classmethod
+    def load(cls,
+             scan:    ScanType,
+             path:    Optional[Path] = None,
+             version: tuple          = ()) -> "MatchList":
+        matches = cls(scan, path, version)
+
+        if not path:
+            return matches
+
+        try:
+            with open(path, "rb") as file:
+                data = pickle.load(file)
+        except FileNotFoundError:
+            return matches
+        except (pickle.UnpicklingError, EOFError, ValueError) as err:
+            LOG.error("Ignoring corrupted match list %r: %s", str(path), err)
+            return matches
+
+        if data.get("format") == FORMAT_VERSION and \
+           data.get("version") == version:
+            matches.rows     = data["rows"]
+            matches.scanned  = data["scanned"]
+            matches.complete = data["complete"]
+
+        return matches
+
+
+    def __getitem__(self, position: int) -> Optional[int]:
+        "Return the row of the nth result, None if there aren't that many."
+        with self._lock:
+            return self._get(position)
+
+
+    def _get(self, position: int) -> Optional[int]:
+        while position >= len(self.rows) and not self.complete:
+            if self._scanner is None:
+                self._scanner = self.scan(self.scanned)
+
+            try:
+                row = next(self._scanner)
+            except StopIteration:
+                self.complete  = True
+                self._scanner  = None
+                self._modified = True
+                break
+
+            self.rows.append(row)
+            self.scanned   = row + 1
+            self._modified = True
+
+        return self.rows[position] if position < len(self.rows) else None
+
+
+    def __iter__(self) -> Iterator[int]:
+        position = 0
+        while True:
+            row = self[position]
+            if row is None:
+                return
+            yield row
+            position += 1
+
+
+    def count(self) -> int:
+        "Find all the remaining matches and return their number."
+        for _ in self:
+            pass
+        return len(self.rows)
+
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+
+    def _save(self) -> None:
+        if not self.path or not self._modified:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with AtomicFile(self.path, "wb") as file:
+            pickle.dump({"format":   FORMAT_VERSION,
+                         "version":  self.version,
+                         "rows":     self.rows,
+                         "scanned":  self.scanned,
+                         "complete": self.complete},
+                        file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._modified = False
+
+        saved = sorted(self.path.parent.iterdir(),
+                       key=lambda p: p.stat().st_mtime)
+
+        for old in saved[:-MAX_SAVED]:
+            old.unlink()
@@ -0,0 +1,107 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+"Persistent MD5 hash to post lookup table for local post collections."
+
+import pickle
+from pathlib import Path
+from sys import intern
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from atomicfile import AtomicFile
+
+from .. import LOG
+from .tagindex import StatType
+
+FORMAT_VERSION = 1
+
+# Most hashes belong to a single post, only use tuples for the others
+EntryType = Union[str, Tuple[str, ...]]
+
+
+class Md5Index:
+    "Map post MD5 hashes to the directory names of the posts having them."
+
+    def __init__(self,
+                 path:    Path,
+                 entries: Optional[Dict[str, EntryType]] = None,
+                 source:  Optional[StatType]             = None) -> None:
+        self.path:    Path                 = path
+        self.entries: Dict[str, EntryType] = entries or {}
+        # Stat of the index.tsv this index is in sync with
+        self.source:  Optional[StatType]   = source
+
+
+    @classmethod
+    def load(cls, path: Path, source: Optional[StatType] = None
+            ) -> Optional["Md5Index"]:
+        "Load a saved index, return None if it is missing or out of sync."
+        try:
+            with open(path, "rb") as file:
+                data = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError) as err:
+            LOG.error("Corrupted MD5 index %r, will rebuild: %s",
+                      str(path), err)
+            return None
+
+        if data.get("version") != FORMAT_VERSION or \
+           (source and tuple(data.get("source") or ()) != source):
+            return None
+
+        return cls(path, data["entries"], tuple(data["source"]))
+
+
+    @classmethod
+    def build(cls, path: Path, posts: Iterable[Tuple[str, str]]
+             ) -> "Md5Index":
+        "Create an index from (md5, post dirname) pairs."
+        index = cls(path)
+        index.update(added=posts)
+        return index
+
+
+    def save(self, source: Optional[StatType] = None) -> None:
+        self.source = source or self.source
+
+        with AtomicFile(self.path, "wb") as file:
+            pickle.dump({"version": FORMAT_VERSION,
+                         "source":  self.source,
+                         "entries": self.entries},
+                        file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def update(self,
+               added:   Iterable[Tuple[str, str]] = (),
+               removed: Iterable[Tuple[str, str]] = ()) -> None:
+        "Add and remove (md5, post dirname) pairs."
+
+        for md5, dirname in removed:
+            kept = [d for d in self.get(md5) if d != dirname]
+
+            if kept:
+                self.entries[md5] = kept[0] if len(kept) == 1 else tuple(kept)
+            else:
+                self.entries.pop(md5, None)
+
+        for md5, dirname in added:
+            if not md5:
+                continue
+
+            entry = self.entries.get(md5)
+
+            if entry is None:
+                self.entries[intern(md5)] = dirname
+            elif dirname not in self.get(md5):
+                self.entries[md5] = (*self.get(md5), dirname)
+
+
+    def get(self, md5: str) -> List[str]:
+        "Return the directory names of posts having a MD5 hash."
+        entry = self.entries.get(md5)
+
+        if entry is None:
+            return []
+
+        return [entry] if isinstance(entry, str) else list(entry)
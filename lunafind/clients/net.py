@@ -5,7 +5,7 @@
 
 import abc
 import threading
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 
 import urllib3
 from dataclasses import dataclass, field
@@ -13,7 +13,7 @@ from dataclasses import dataclass, field
 import requests
 from requests.adapters import HTTPAdapter
 
-from . import base
+from . import base, httpcache
 from .. import LOG, config
 
 # Set the maximum number of total requests/threads that can be running at once.
@@ -44,6 +44,11 @@ class NetClient(base.Client, abc.ABC):
     name:     str = "netclient"
     site_url: str = ""
 
+    # aionet.Transport used by async methods, aionet.shared() if None
+    transport: Any = field(init=False, default=None, repr=False)
+    # httpcache.HttpCache for API responses, httpcache.shared() if None
+    cache:     Any = field(init=False, default=None, repr=False)
+
     _session: requests.Session = field(init=False, default=None, repr=False)
 
 
@@ -54,8 +59,28 @@ class NetClient(base.Client, abc.ABC):
             self._session.mount(scheme, HTTPAdapter(max_retries=RETRY))
 
 
-    def http(self, http_method: str, url: str, **request_kwargs
-            ) -> Optional[requests.models.Response]:
+    def http(self,
+             http_method: str,
+             url:         str,
+             cache_mode:  Optional[str] = None,
+             **request_kwargs) -> Optional[requests.models.Response]:
+        """Send a request, return None if it failed.
+
+        GET responses for API endpoints are cached on disk,
+        `cache_mode` can be `use`, `refresh` or `bypass`
+        (see clients.httpcache.MODES)."""
+
+        if http_method.lower() == "get" and not request_kwargs.get("stream"):
+            send = lambda **kwargs: self._http(http_method, url, **kwargs)
+            return (self.cache or httpcache.shared()).get(
+                send, url, cache_mode, **request_kwargs
+            )
+
+        return self._http(http_method, url, **request_kwargs)
+
+
+    def _http(self, http_method: str, url: str, **request_kwargs
+             ) -> Optional[requests.models.Response]:
         try:
             with MAX_PARALLEL_REQUESTS_SEMAPHORE:
                 response = self._session.request(
@@ -70,6 +95,18 @@ class NetClient(base.Client, abc.ABC):
         return response
 
 
+    @property
+    def aio(self) -> "aionet.Transport":
+        from . import aionet  # avoid circular import
+        return self.transport or aionet.shared()
+
+
+    async def http_async(self, http_method: str, url: str, **request_kwargs
+                        ) -> Optional[bytes]:
+        "Return the body of a response, None if the request failed."
+        return await self.aio.read(http_method, url, **request_kwargs)
+
+
     @abc.abstractmethod
     def info_id(self, post_id: int) -> Optional[base.InfoType]:
         return None
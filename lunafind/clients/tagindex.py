@@ -0,0 +1,264 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+"Persistent inverted tag index for local post collections."
+
+import pickle
+import zlib
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from sys import intern
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from atomicfile import AtomicFile
+
+from .. import LOG, utils
+
+FORMAT_VERSION = 2
+
+PostingType = array  # array("q") of sorted post keys
+StatType    = Tuple[int, int]
+
+# Bits of a post key holding the post ID
+POST_ID_MASK = (1 << 40) - 1
+
+
+def post_key(fetched_from: str, post_id: int) -> int:
+    "Return an integer uniquely identifying a post from a particular booru."
+    return (zlib.crc32(fetched_from.encode()) & 0x7FFFFF) << 40 | post_id
+
+
+def file_stat(path: Path) -> Optional[StatType]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _contains(posting: PostingType, key: int) -> bool:
+    i = bisect_left(posting, key)
+    return i != len(posting) and posting[i] == key
+
+
+class TagIndex:
+    "Map every tag to a sorted posting list of the keys of posts having it."
+
+    def __init__(self,
+                 path:     Path,
+                 postings: Optional[Dict[str, PostingType]] = None,
+                 source:   Optional[StatType]               = None,
+                 total:    int                              = 0) -> None:
+        self.path:     Path                   = path
+        self.postings: Dict[str, PostingType] = postings or {}
+        # Stat of the index.tsv this tag index is in sync with
+        self.source:   Optional[StatType]     = source
+        # Number of indexed posts
+        self.total:    int                    = total
+
+        self._expansions: Dict[str, Set[str]] = {}
+
+
+    @classmethod
+    def load(cls, path: Path, source: Optional[StatType] = None
+            ) -> Optional["TagIndex"]:
+        "Load a saved index, return None if it is missing or out of sync."
+        try:
+            with open(path, "rb") as file:
+                data = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError) as err:
+            LOG.error("Corrupted tag index %r, will rebuild: %s",
+                      str(path), err)
+            return None
+
+        if data.get("version") != FORMAT_VERSION or \
+           (source and tuple(data.get("source") or ()) != source):
+            return None
+
+        return cls(path, data["postings"], tuple(data["source"]),
+                   data["total"])
+
+
+    @classmethod
+    def build(cls, path: Path, posts: Iterable[Tuple[int, str]]
+             ) -> "TagIndex":
+        "Create an index from (post key, tag string) pairs."
+        lists: Dict[str, List[int]] = {}
+        total                       = 0
+
+        for key, tag_string in posts:
+            total += 1
+            for tag in tag_string.split():
+                lists.setdefault(tag, []).append(key)
+
+        return cls(path, {intern(t): array("q", sorted(keys))
+                          for t, keys in lists.items()}, total=total)
+
+
+    def save(self, source: Optional[StatType] = None) -> None:
+        self.source = source or self.source
+
+        with AtomicFile(self.path, "wb") as file:
+            pickle.dump({"version":  FORMAT_VERSION,
+                         "source":   self.source,
+                         "total":    self.total,
+                         "postings": self.postings},
+                        file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def update(self,
+               added:   Iterable[Tuple[int, str]] = (),
+               removed: Iterable[Tuple[int, str]] = ()) -> None:
+        "Add and remove (post key, tag string) pairs from posting lists."
+        adds: Dict[str, Set[int]] = {}
+        dels: Dict[str, Set[int]] = {}
+
+        self._expansions.clear()
+
+        for key, tag_string in added:
+            self.total += 1
+            for tag in tag_string.split():
+                adds.setdefault(tag, set()).add(key)
+
+        for key, tag_string in removed:
+            self.total -= 1
+            for tag in tag_string.split():
+                dels.setdefault(tag, set()).add(key)
+
+        for tag in set(adds) | set(dels):
+            keys = set(self.postings.get(tag, ()))
+            keys = (keys - dels.get(tag, set())) | adds.get(tag, set())
+
+            if keys:
+                self.postings[intern(tag)] = array("q", sorted(keys))
+            else:
+                self.postings.pop(tag, None)
+
+
+    def expand(self, tag: str) -> Set[str]:
+        "Return the indexed tags matching a tag with * wildcards."
+        if "*" not in tag:
+            return {tag} if tag in self.postings else set()
+
+        try:
+            return self._expansions[tag]
+        except KeyError:
+            pass
+
+        inner = tag.strip("*")
+
+        if "*" in inner:
+            regex   = utils.wildcard2regex(tag)
+            matches = {t for t in self.postings if regex.fullmatch(t)}
+        elif tag.startswith("*") and tag.endswith("*"):
+            matches = {t for t in self.postings if inner in t}
+        elif tag.startswith("*"):
+            matches = {t for t in self.postings if t.endswith(inner)}
+        else:
+            matches = {t for t in self.postings if t.startswith(inner)}
+
+        self._expansions[tag] = matches
+        return matches
+
+
+    def posting(self, tag: str) -> PostingType:
+        return self.postings.get(tag, array("q"))
+
+
+    def frequencies(self, tags: Iterable[str]) -> Dict[str, float]:
+        """Return the proportion of indexed posts having each tag.
+
+        Wildcard and unknown tags are left out, since they can match other
+        tags, e.g. when searching with partial tags."""
+        if not self.total:
+            return {}
+        return {t: len(self.postings[t]) / self.total
+                for t in tags if t in self.postings}
+
+
+    def intersection(self, tags: Iterable[str]) -> Set[int]:
+        lists = sorted((self.posting(t) for t in tags), key=len)
+
+        if not lists:
+            return set()
+
+        result = set(lists[0])
+
+        for posting in lists[1:]:
+            if not result:
+                break
+
+            # Binary search the big lists instead of hashing all their items
+            if len(posting) > len(result) * 16:
+                result = {k for k in result if _contains(posting, k)}
+            else:
+                result &= set(posting)
+
+        return result
+
+
+    def count(self,
+              required: Iterable[str] = (),
+              excluded: Iterable[str] = (),
+              any_of:   Iterable[str] = ()) -> int:
+        "Return the number of posts matching the given plain tags."
+
+        required, excluded = list(required), list(excluded)
+        any_of             = list(any_of)
+
+        if len(required) == 1 and not excluded and not any_of:
+            return len(self.posting(required[0]))
+
+        include, exclude = self.resolve(required, excluded, any_of)
+        return self.total - len(exclude) if include is None else len(include)
+
+
+    def union(self, tags: Iterable[str]) -> Set[int]:
+        result: Set[int] = set()
+        for tag in tags:
+            result.update(self.posting(tag))
+        return result
+
+
+    def resolve(self,
+                required:     Iterable[str]      = (),
+                excluded:     Iterable[str]      = (),
+                any_of:       Iterable[str]      = (),
+                required_any: Iterable[Set[str]] = (),
+               ) -> Tuple[Optional[Set[int]], Set[int]]:
+        """Return (keys to include, keys to exclude) for the given plain tags.
+
+        Posts must also have at least one tag from each required_any set,
+        e.g. the expansions of wildcard tags.
+        The keys to include are None if there are no required or any_of tags,
+        meaning every post not excluded is a candidate."""
+
+        required, any_of = list(required), list(any_of)
+        include          = self.intersection(required) if required else None
+
+        for tags in sorted(required_any, key=len):
+            postings = [self.posting(t) for t in tags]
+
+            # Check the few candidates left instead of building a big union
+            if include is not None and \
+               len(include) * len(postings) * 16 < sum(map(len, postings)):
+                include = {k for k in include
+                           if any(_contains(p, k) for p in postings)}
+            else:
+                union   = self.union(tags)
+                include = union if include is None else include & union
+
+        if any_of:
+            union   = self.union(any_of)
+            include = union if include is None else include & union
+
+        exclude = self.union(excluded)
+
+        if include is not None:
+            include -= exclude
+            exclude  = set()
+
+        return (include, exclude)
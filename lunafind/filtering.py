@@ -1,18 +1,24 @@
 # Copyright 2018 miruka
 # This file is part of lunafind, licensed under LGPLv3.
 
+import abc
+import functools
 import re
 import shlex
-from typing import Generator, Iterable, Optional, Set, Union
+from typing import (
+    Any, AsyncGenerator, AsyncIterable, Callable, Dict, FrozenSet, Generator,
+    Iterable, List, Optional, Pattern, Set, Tuple, Union
+)
 
 import pendulum as pend
+from dataclasses import dataclass, field
 
 import whratio
 # pylint: disable=no-name-in-module
 from fastnumbers import fast_float, fast_int
 
 from . import LOG, utils
-from .clients.base import InfoType
+from .clients.base import InfoType, LazyInfo
 from .post import Post
 
 
@@ -25,6 +31,29 @@ def safe_int(value) -> int:
     return fast_int(value, 0)
 
 
+# (tag_string, its tags) for the last non-LazyInfo passed to tag_set()
+_LAST_TAG_SET: Tuple[Optional[str], FrozenSet[str]] = (None, frozenset())
+
+def tag_set(info: InfoType) -> FrozenSet[str]:
+    """Return the tags of a post as a set.
+
+    Tags are split once per post, and reused by all the terms and filters
+    checking it in a row."""
+
+    global _LAST_TAG_SET  # pylint: disable=global-statement
+
+    if isinstance(info, LazyInfo):
+        return info.tag_set()
+
+    string, tags = _LAST_TAG_SET
+    if info["tag_string"] is not string:
+        string        = info["tag_string"]
+        tags          = frozenset(string.split())
+        _LAST_TAG_SET = (string, tags)
+
+    return tags
+
+
 META_NUM_TAGS = {
     "width":    ["image_width",         safe_int],
     "height":   ["image_height",        safe_int],
@@ -63,6 +92,25 @@ META_NUM_TAGS = {
 }
 
 
+# Terms that need dates to be parsed for every post
+META_DATE_TAGS = {"date", "age", "fetch", "fetchage"}
+
+# Meta tags with values relative to the current time
+META_TIME_RELATIVE_TAGS = {"age", "fetchage"}
+
+# Values precomputed by some infos (see LazyInfo.derived) usable instead of
+# the META_NUM_TAGS functions: tag: (derived name, search value converter)
+META_NUM_DERIVED = {
+    "mpixels":  ("mpixels",          None),
+    "ratio":    ("ratio",            None),
+    "child":    ("child_count",      None),
+    "date":     ("created_at_epoch", utils.date2epoch),
+    "age":      ("created_at_epoch", utils.date2epoch),
+    "fetch":    ("fetched_at_epoch", utils.date2epoch),
+    "fetchage": ("fetched_at_epoch", utils.date2epoch),
+}
+
+
 def _source_match(info: InfoType, value: str, key: str = "source") -> bool:
     if value == "none":
         return not info[key]
@@ -91,142 +139,389 @@ META_STR_TAGS_FUNCS = {
 }
 
 
-def _tag_present(info: InfoType, tag: str) -> bool:
-    # Avoid regex unless no choice, they have bad performances.
-    # Wrap strings in spaces to match tags even if they're at start/end.
-    if "*" not in tag:
-        return f" {tag} " in f" {info['tag_string']} "
+# Max number of tags for which each wildcard tag term remembers if it matches
+TAG_MATCHES_CACHE = 8192
 
-    if tag == "*":
-        return True
 
-    if "*" in tag and "*" not in tag[1:-1]:
-        tag = f"{tag[1:]}"  if tag[0]  == "*" else f" {tag}"
-        tag = f"{tag[:-1]}" if tag[-1] == "*" else f"{tag} "
-        return tag in f" {info['tag_string']} "
+@dataclass(frozen=True)
+class Term(abc.ABC):
+    "Base for compiled search terms, prefix can be '', '-' or '~'."
 
-    # Non-standard: support wildcards in "-tag" or "~tag".
-    # "*" in tag → ".*?" regex, escape other regex/special chars
-    return re.search(r" %s " % re.escape(tag).replace(r"\*", r".*?"),
-                     r" %s " % info["tag_string"],
-                     re.IGNORECASE)
+    text:   str
+    prefix: str
 
+    @property
+    def cost(self) -> float:
+        "Rough relative evaluation cost, used to decide what to try first."
+        return 1
 
-def _meta_num_match(info: InfoType, tag: str, value: str) -> bool:
-    convert = META_NUM_TAGS[tag][1]
+    @abc.abstractmethod
+    def present(self, info: InfoType) -> bool:
+        return False
 
-    info_v = META_NUM_TAGS[tag][0]
-    info_v = convert(
-        info_v(info) if callable(META_NUM_TAGS[tag][0]) else info[info_v]
-    )
 
-    eq_fuzzy_20 = "eq_fuzzy_20" in META_NUM_TAGS[tag]
-    reverse_cmp = "reverse_cmp" in META_NUM_TAGS[tag]
+@dataclass(frozen=True)
+class TagTerm(Term):
+    tag:     str
+    exact:   bool              = False
+    needle:  Optional[str]     = None  # For wildcards at the tag's edges
+    pattern: Optional[Pattern] = None  # For wildcards inside the tag
+
+    # Whether a tag matches the wildcards, for pattern remembered for the
+    # last tags tried
+    matches: Optional[Callable[[str], bool]] = \
+        field(default=None, init=False, compare=False, repr=False)
+
+    def __post_init__(self) -> None:
+        needle = self.needle
+
+        if self.pattern is not None:
+            fullmatch = self.pattern.fullmatch
+            matches   = functools.lru_cache(maxsize=TAG_MATCHES_CACHE)(
+                lambda tag: fullmatch(tag) is not None
+            )
+        elif needle is not None and self.tag[0] != "*":
+            matches = lambda tag: tag.startswith(needle)
+        elif needle is not None and self.tag[-1] != "*":
+            matches = lambda tag: tag.endswith(needle)
+        elif needle is not None:
+            matches = lambda tag: needle in tag
+        else:
+            return
+
+        object.__setattr__(self, "matches", matches)
+
+    @property
+    def cost(self) -> float:
+        return 3 if self.pattern is not None else \
+               2 if self.needle  is not None else 1
+
+    def present(self, info: InfoType) -> bool:
+        if self.exact:
+            return self.tag in tag_set(info)
+
+        if self.matches is not None:
+            return any(map(self.matches, tag_set(info)))
+
+        return True  # "*"
+
+
+@dataclass(frozen=True)
+class MetaNumTerm(Term):
+    tag:            str
+    op:             str
+    values:         Tuple[Any, ...]
+    get:            Callable[[InfoType], Any]
+    fuzzy_20:       bool            = False
+    reverse:        bool            = False
+    derived:        Optional[str]   = None
+    derived_values: Tuple[Any, ...] = ()
+
+    @property
+    def cost(self) -> float:
+        return 8 if self.tag in META_DATE_TAGS else 2
+
+    def _compare(self, info_v: Any, values: Tuple[Any, ...]) -> bool:
+        op = self.op
 
-    def compare(convert, info_v, value, eq_fuzzy_20, reverse_cmp) -> bool:
         # Non-standard: none/any supported for all meta numeric tags.
-        if value == "none":
+        if op == "none":
             return bool(not info_v)
 
-        if value == "any":
+        if op == "any":
             return bool(info_v)
 
-        if value.startswith(">="):
-            return info_v >= convert(value[2:])
-        if value.endswith(".."):
-            return info_v >= convert(value[:-2])
+        if op == ">=":
+            return info_v >= values[0]
 
-        if value.startswith("<=") or value.startswith(".."):
-            return info_v <= convert(value[2:])
+        if op == "<=":
+            return info_v <= values[0]
 
-        if value.startswith(">"):
-            return info_v > convert(value[1:])
+        if op == ">":
+            return info_v > values[0]
 
-        if value.startswith("<"):
-            return info_v < convert(value[1:])
+        if op == "<":
+            return info_v < values[0]
 
-        if ".." in value:
-            begin, end = value.split("..", maxsplit=1)
+        if op == "range":
+            in_range = values[0] <= info_v <= values[1]
+            return not in_range if self.reverse else in_range
 
-            if reverse_cmp:
-                begin, end = end, begin
-                return not convert(begin) <= info_v <= convert(end)
+        if op == "in":
+            return str(info_v) in values
 
-            return convert(begin) <= info_v <= convert(end)
+        if op == "in_fuzzy":
+            return any(v - v / 20 <= info_v <= v + v / 20 for v in values)
 
-        if "," in value:
-            if not eq_fuzzy_20:
-                return str(info_v) in value.split(",")
+        if op == "eq_fuzzy":
+            # For filesize, it's what Danbooru does apparently
+            # (not sure if this is the exact formula but close enough?).
+            return values[0] - values[0] / 20 <= info_v <= \
+                   values[0] + values[0] / 20
 
-            return bool([v for v in value.split(",") if
-                         v - v / 20 <= info_v <= v + v / 20])
+        return info_v == values[0]
 
+    def present(self, info: InfoType) -> bool:
+        info_v = None
 
-        try:
-            value = convert(value)
+        if self.derived and isinstance(info, LazyInfo):
+            info_v = info.derived(self.derived)
 
-            if eq_fuzzy_20:
-                # For filesize, it's what Danbooru does apparently
-                # (not sure if this is the exact formula but close enough?).
-                return value - value / 20 <= info_v <= value + value / 20
+        if info_v is None:
+            result = bool(self._compare(self.get(info), self.values))
+        else:
+            result = bool(self._compare(info_v, self.derived_values))
 
-            return info_v == value
-        except Exception:
-            pass
+        return result if not self.reverse else not result
 
-        raise ValueError(f"Invalid search term value: '{tag}:{value}'.")
 
-    result = compare(convert, info_v, value, eq_fuzzy_20, reverse_cmp)
-    return result if not reverse_cmp else not result
+@dataclass(frozen=True)
+class MetaStrTerm(Term):
+    func:  Callable[[InfoType, str], Any]
+    value: str
 
+    @property
+    def cost(self) -> float:
+        return 6 if self.func is _source_match else 1
 
-def _filter_info(info:        InfoType,
-                 simple_tags: Set[str],
-                 meta_num:    Set[str],
-                 meta_str:    Set[str]) -> bool:
+    def present(self, info: InfoType) -> bool:
+        return bool(self.func(info, self.value))
 
-    no_prefix = lambda tag: tag[1:] if tag[0] in ("-", "~") else tag
-    presences    = {}
 
-    for tag in simple_tags:
-        presences[tag] = _tag_present(info, no_prefix(tag))
+@dataclass(frozen=True)
+class Query:
+    "Compiled search: all required, none of excluded, one of any_of terms."
 
-    for tag_val in meta_num:
-        tag, value         = tag_val.split(":", maxsplit=1)
-        presences[tag_val] = _meta_num_match(info, no_prefix(tag), value)
+    required: Tuple[Term, ...] = ()
+    excluded: Tuple[Term, ...] = ()
+    any_of:   Tuple[Term, ...] = ()
 
-    for tag_val in meta_str:
-        tag, value         = tag_val.split(":", maxsplit=1)
-        presences[tag_val] = META_STR_TAGS_FUNCS[no_prefix(tag)](info, value)
+    def match(self, info: InfoType) -> bool:
+        for term in self.excluded:
+            if term.present(info):
+                return False
 
-    tilde_tag_in_search   = False
-    one_tilde_tag_present = False
+        for term in self.required:
+            if not term.present(info):
+                return False
 
-    for term, present in presences.items():
-        if term[0] == "-" and present:
-            return False
+        if self.any_of:
+            return any(term.present(info) for term in self.any_of)
 
-        if term[0] not in ("-", "~") and not present:
-            return False
+        return True
+
+    def __bool__(self) -> bool:
+        return bool(self.required or self.excluded or self.any_of)
+
+    @property
+    def tags(self) -> Set[str]:
+        "Tags (without prefixes) used by the simple tag terms."
+        return {t.tag for t in self.required + self.excluded + self.any_of
+                if isinstance(t, TagTerm)}
+
+    @property
+    def time_relative(self) -> bool:
+        "Whether results depend on the current time, e.g. for age:<1w."
+        return any(isinstance(t, MetaNumTerm) and
+                   t.tag in META_TIME_RELATIVE_TAGS
+                   for t in self.required + self.excluded + self.any_of)
+
+
+class Matcher:
+    """Evaluate a Query, trying first the cheap terms most likely to decide.
+
+    Terms are ordered by cost divided by the estimated probability of them
+    alone deciding the result (a required term being absent, an excluded
+    term being present). Probabilities start from the given estimates
+    (tag: probability of being present on a post), and are refined from
+    the pass rates observed while matching."""
+
+    reorder_every = 256
+    prior_weight  = 4
+
+    def __init__(self,
+                 query:     Query,
+                 estimates: Optional[Dict[str, float]] = None) -> None:
+
+        estimates = estimates or {}
 
-        if term[0] == "~":
-            tilde_tag_in_search = True
+        def stats(term: Term) -> List[float]:
+            # [prior probability of being present, times seen, times present]
+            return [estimates.get(getattr(term, "tag", None), 0.5), 0, 0]
+
+        self.query   = query
+        self._checks = [(t, stats(t)) for t in query.required + query.excluded]
+        self._any_of = [(t, stats(t)) for t in query.any_of]
+        self._count  = 0
+        self._reorder()
+
+
+    def _rank(self, term: Term, stats: List[float]) -> float:
+        prior, seen, present = stats
+        weight  = self.prior_weight
+        p_there = (present + prior * weight) / (seen + weight)
+        p_decisive = p_there if term.prefix in ("-", "~") else 1 - p_there
+        return term.cost / max(p_decisive, 0.01)
+
+
+    def _reorder(self) -> None:
+        self._checks.sort(key=lambda ts: self._rank(*ts))
+        self._any_of.sort(key=lambda ts: self._rank(*ts))
+
+
+    def match(self, info: InfoType) -> bool:
+        self._count += 1
+        if self._count % self.reorder_every == 0:
+            self._reorder()
+
+        for term, stats in self._checks:
+            present   = term.present(info)
+            stats[1] += 1
+            stats[2] += present
+
+            if present == (term.prefix == "-"):
+                return False
+
+        if not self._any_of:
+            return True
+
+        for term, stats in self._any_of:
+            present   = term.present(info)
+            stats[1] += 1
+            stats[2] += present
 
             if present:
-                one_tilde_tag_present = True
+                return True
 
-    if tilde_tag_in_search and not one_tilde_tag_present:
         return False
 
-    return True
 
+def _compile_tag(term: str, tag: str) -> TagTerm:
+    if "*" not in tag:
+        return TagTerm(term, term[0], tag, exact=True)
+
+    if tag == "*":
+        return TagTerm(term, term[0], tag)
+
+    if "*" not in tag[1:-1]:
+        return TagTerm(term, term[0], tag, needle=tag.strip("*"))
+
+    # Non-standard: support wildcards in "-tag" or "~tag".
+    return TagTerm(term, term[0], tag, pattern=utils.wildcard2regex(tag))
+
+
+def _compile_meta_num(term: str, tag: str, value: str) -> MetaNumTerm:
+    key, convert = META_NUM_TAGS[tag][:2]
+    fuzzy_20     = "eq_fuzzy_20" in META_NUM_TAGS[tag]
+    reverse      = "reverse_cmp" in META_NUM_TAGS[tag]
+
+    get = (lambda info: convert(key(info))) if callable(key) else \
+          (lambda info: convert(info[key]))
+
+    def conv(*values: str) -> Tuple[Any, ...]:
+        try:
+            return tuple(convert(v) for v in values)
+        except Exception:
+            raise ValueError(f"Invalid search term value: '{tag}:{value}'.")
+
+    if value in ("none", "any"):
+        op, values = value, ()
+    elif value.startswith(">="):
+        op, values = ">=", conv(value[2:])
+    elif value.endswith(".."):
+        op, values = ">=", conv(value[:-2])
+    elif value.startswith("<=") or value.startswith(".."):
+        op, values = "<=", conv(value[2:])
+    elif value.startswith(">"):
+        op, values = ">", conv(value[1:])
+    elif value.startswith("<"):
+        op, values = "<", conv(value[1:])
+    elif ".." in value:
+        begin, end = value.split("..", maxsplit=1)
+        op, values = "range", conv(end, begin) if reverse else conv(begin, end)
+    elif "," in value and fuzzy_20:
+        op, values = "in_fuzzy", conv(*value.split(","))
+    elif "," in value:
+        op, values = "in", frozenset(value.split(","))
+    else:
+        op, values = "eq_fuzzy" if fuzzy_20 else "eq", conv(value)
+
+    derived, derived_values = None, ()
+
+    # "in" compares value strings, none/any would be wrong for epoch 0
+    if tag in META_NUM_DERIVED and op != "in" and \
+       not (tag in META_DATE_TAGS and op in ("none", "any")):
+
+        derived, to_derived = META_NUM_DERIVED[tag]
+        derived_values      = tuple(map(to_derived, values)) if to_derived \
+                              else values
+
+    return MetaNumTerm(term, term[0], tag, op, values, get, fuzzy_20, reverse,
+                       derived, derived_values)
+
+
+def _compile_term(term: str, kind: str) -> Term:
+    no_prefix = lambda tag: tag[1:] if tag[0] in ("-", "~") else tag
+
+    if kind == "tag":
+        return _compile_tag(term, no_prefix(term))
+
+    tag, value = term.split(":", maxsplit=1)
+
+    if kind == "meta_num":
+        return _compile_meta_num(term, no_prefix(tag), value)
+
+    return MetaStrTerm(term, term[0], META_STR_TAGS_FUNCS[no_prefix(tag)],
+                       value)
 
-def filter_all(items:         Iterable[Union[InfoType, Post]],
-               terms:         str,
-               raw:           bool = False,
-               stop_on_match: bool = False,
-               partial_tags:  bool = False,
-              ) -> Generator[Union[InfoType, Post], None, int]:
+
+def compile_query(terms:        str,
+                  raw:          bool = False,
+                  partial_tags: bool = False) -> Query:
+    """Parse a search string once into a reusable Query.
+
+    Results are cached by arguments, except queries with relative dates
+    like "age:<1w": these are compiled again to compare with the
+    current time."""
+
+    if _time_relative(terms, raw):
+        return _compile_query(terms, raw, partial_tags)
+
+    return _compile_query_cached(terms, raw, partial_tags)
+
+
+@functools.lru_cache(maxsize=256)
+def _time_relative(terms: str, raw: bool) -> bool:
+    meta_num = parse_terms(terms, raw)[1]
+    return any(t.lstrip("-~").split(":")[0] in META_TIME_RELATIVE_TAGS
+               for t in meta_num)
+
+
+def _compile_query(terms: str, raw: bool, partial_tags: bool) -> Query:
+    tags, meta_num, meta_str = parse_terms(terms, raw)
+
+    if partial_tags:
+        tags = {re.sub(r"^(-|~)?(.+)", r"\1*\2*", t) for t in tags}
+
+    compiled = [_compile_term(t, kind)
+                for kind, group in (("tag",      tags),
+                                    ("meta_num", meta_num),
+                                    ("meta_str", meta_str))
+                for t in sorted(group)]
+
+    return Query(
+        required = tuple(t for t in compiled if t.prefix not in ("-", "~")),
+        excluded = tuple(t for t in compiled if t.prefix == "-"),
+        any_of   = tuple(t for t in compiled if t.prefix == "~"),
+    )
+
+
+_compile_query_cached = functools.lru_cache(maxsize=256)(_compile_query)
+
+
+def parse_terms(terms: str, raw: bool = False
+               ) -> Tuple[Set[str], Set[str], Set[str]]:
+    "Split a search into (simple tags, meta numeric, meta string) terms."
 
     def raw_tag(term: str) -> Optional[str]:
         if not ":" in term:
@@ -238,11 +533,36 @@ def filter_all(items:         Iterable[Union[InfoType, Post]],
     meta_num  = set(t for t in terms if raw_tag(t) in META_NUM_TAGS)
     meta_str  = set(t for t in terms if raw_tag(t) in META_STR_TAGS_FUNCS)
     tags      = terms - set(meta_num) - set(meta_str)
+    return (tags, meta_num, meta_str)
 
-    if partial_tags:
-        tags = {re.sub(r"^(-|~)?(.+)", r"\1*\2*", t) for t in tags}
 
-    term_args = (tags, meta_num, meta_str)
+def filter_all(items:         Iterable[Union[InfoType, Post]],
+               terms:         Union[str, Query],
+               raw:           bool = False,
+               stop_on_match: bool = False,
+               partial_tags:  bool = False,
+               estimates:     Optional[Dict[str, float]] = None,
+               batch_size:    int                         = 0,
+              ) -> Generator[Union[InfoType, Post], None, int]:
+    """Yield items matching a search, return the number discarded.
+
+    If batch_size is set and NumPy is installed, numeric terms are
+    evaluated for that many items at once. Items will only be yielded
+    after their whole batch has been read."""
+
+    query = terms if isinstance(terms, Query) else \
+            compile_query(terms, raw, partial_tags)
+
+    if batch_size > 1 and not stop_on_match:
+        from . import batchfilter  # avoid circular import
+
+        if batchfilter.available():
+            batch = batchfilter.BatchFilter(query, estimates)
+
+            if batch.terms:
+                return (yield from batch.filter(items, batch_size))
+
+    query = Matcher(query, estimates)
 
     discarded = 0
 
@@ -251,13 +571,13 @@ def filter_all(items:         Iterable[Union[InfoType, Post]],
 
         try:
             if stop_on_match:
-                if not _filter_info(info, *term_args):
+                if not query.match(info):
                     yield item
                 else:
                     return 0
 
             else:
-                if _filter_info(info, *term_args):
+                if query.match(info):
                     yield item
                 else:
                     discarded += 1
@@ -266,3 +586,86 @@ def filter_all(items:         Iterable[Union[InfoType, Post]],
             LOG.warning("No %r key for post %d.", err.args[0], info["id"])
 
     return discarded
+
+
+@dataclass
+class FilterStage:
+    "A search checked by filter_stages(), with its discarded posts count."
+
+    name:      str
+    query:     Query
+    stop:      bool                       = False
+    estimates: Optional[Dict[str, float]] = field(default=None, repr=False)
+    discarded: int                        = 0
+
+
+class _StagesChecker:
+    "Check items against filter stages, counting discarded items."
+
+    def __init__(self, stages: Iterable[FilterStage]) -> None:
+        self.checks    = [(s, Matcher(s.query, s.estimates).match)
+                          for s in stages]
+        self.discarded = 0
+
+
+    def __call__(self, item: Union[InfoType, Post]) -> Optional[bool]:
+        "Return if an item passes, None if the iteration must stop."
+        info = item.info if isinstance(item, Post) else item
+
+        try:
+            for stage, match in self.checks:
+                if match(info) == stage.stop:
+                    break
+            else:
+                return True
+
+        except KeyError as err:
+            LOG.warning("No %r key for post %d.", err.args[0], info["id"])
+            return False
+
+        if stage.stop:
+            return None
+
+        stage.discarded += 1
+        self.discarded  += 1
+        return False
+
+
+def filter_stages(items:  Iterable[Union[InfoType, Post]],
+                  stages: Iterable[FilterStage],
+                 ) -> Generator[Union[InfoType, Post], None, int]:
+    """Yield items matching several searches in a single pass.
+
+    Items must match every stage in order, except stop stages: iteration
+    ends at the first item matching one of them.
+    Each stage counts the items it discarded, the total is returned."""
+
+    check = _StagesChecker(stages)
+
+    for item in items:
+        passed = check(item)
+
+        if passed is None:
+            break
+
+        if passed:
+            yield item
+
+    return check.discarded
+
+
+async def filter_stages_async(items:  AsyncIterable[Union[InfoType, Post]],
+                              stages: Iterable[FilterStage],
+                             ) -> AsyncGenerator[Union[InfoType, Post], None]:
+    "Async version of filter_stages(), for async iterables."
+
+    check = _StagesChecker(stages)
+
+    async for item in items:
+        passed = check(item)
+
+        if passed is None:
+            break
+
+        if passed:
+            yield item
@@ -1,16 +1,40 @@
 # Copyright 2018 miruka
 # This file is part of lunafind, licensed under LGPLv3.
 
+import heapq
+import itertools
+import pickle
 import random
-from typing import List
+import tempfile
+from typing import (
+    IO, Any, Callable, Generator, Iterable, List, Optional, Tuple
+)
 
 import pendulum as pend
 
 # pylint: disable=no-name-in-module
 from fastnumbers import fast_int
 
+from . import LOG, utils
+from .clients import base
+from .clients.base import InfoType, LazyInfo
 from .post import Post
 
+
+def _derived(info: InfoType, name: str) -> Any:
+    return info.derived(name) if isinstance(info, LazyInfo) else None
+
+
+def _mpixels(info: InfoType) -> float:
+    mpixels = _derived(info, "mpixels")
+
+    if mpixels is None:
+        return (fast_int(info["image_width"],  0) *
+                fast_int(info["image_height"], 0)) / 1_000_000
+
+    return mpixels
+
+
 ORDER_NUM = {
     "id":       ("asc",  "id"),
     "score":    ("desc", "score"),
@@ -22,9 +46,7 @@ ORDER_NUM = {
     "chartags": ("desc", "tag_count_character"),
     "copytags": ("desc", "tag_count_copyright"),
     "metatags": ("desc", "tag_count_meta"),
-    "mpixels":  ("desc",
-                 lambda i: (fast_int(i["image_width"],  0) *
-                            fast_int(i["image_height"], 0)) / 1_000_000),
+    "mpixels":  ("desc", _mpixels),
     # Non-standard:
     "width":  ("desc", "image_width"),
     "height": ("desc", "image_height"),
@@ -41,39 +63,207 @@ ORDER_DATE = {
     "fetched": ("desc", "fetched_at"),
 }
 
+# Functions taking a post and the time of the sort in epoch microseconds
 ORDER_FUNCS = {
-    # pylint: disable=unnecessary-lambda
-    "rank":      lambda p: p.info.client.get_post_rank(p),
-    "random":    lambda _: random.random(),
-    "landscape": lambda p: int(p.info["image_width"] > p.info["image_height"]),
-    "portrait":  lambda p: int(p.info["image_height"] > p.info["image_width"]),
+    "rank":      lambda p, now: p.client.get_post_rank(p, now),
+    "random":    lambda _p, _now: random.random(),
+    "landscape": lambda p, _now: int(p.info["image_width"] >
+                                     p.info["image_height"]),
+    "portrait":  lambda p, _now: int(p.info["image_height"] >
+                                     p.info["image_width"]),
 }
 
 
-def sort(posts: List[Post], by: str) -> List[Post]:
-    by_val  = by.replace("asc_", "").replace("desc_", "")
+def parse_by(by: str) -> Tuple[str, bool]:
+    "Return (method, descending) for a `--help-order-values` value."
 
-    in_dict = (ORDER_NUM   if by_val in ORDER_NUM   else
-               ORDER_DATE  if by_val in ORDER_DATE  else
-               ORDER_FUNCS if by_val in ORDER_FUNCS else None)
+    by_val = by.replace("asc_", "").replace("desc_", "")
 
-    if not in_dict:
+    if by_val in ORDER_NUM or by_val in ORDER_DATE:
+        default = {**ORDER_NUM, **ORDER_DATE}[by_val][0]
+    elif by_val in ORDER_FUNCS:
+        default = "asc" if by_val == "random" else "desc"
+    else:
         raise ValueError(
             f"Got {by_val!r} as ordering method, must be one of: %s" %
             ", ".join(set(ORDER_NUM) | set(ORDER_DATE) | set(ORDER_FUNCS))
         )
 
-    if in_dict == ORDER_FUNCS:
-        posts.sort(key=ORDER_FUNCS[by], reverse=(by != "random"))
-        return posts
+    direction = by.split("_")[0] if by != by_val else default
+    return (by_val, direction == "desc")
+
+
+def parse_top(top: Optional[int]) -> Optional[int]:
+    "Return how many first posts to keep, None for all if top is negative."
+    return top if top is not None and top >= 0 else None
+
+
+def _key_and_reverse(by: str) -> Tuple[Callable[[Post], Any], bool]:
+    by_val, reverse = parse_by(by)
+
+    if by_val in ORDER_FUNCS:
+        func, now = ORDER_FUNCS[by_val], utils.date2epoch(pend.now())
+        return (lambda post: func(post, now), reverse)
+
+    in_dict = ORDER_NUM if by_val in ORDER_NUM else ORDER_DATE
+    key     = in_dict[by_val][1]
+
+    if in_dict == ORDER_DATE:
+        def sort_key(post: Post) -> Optional[int]:
+            epoch = _derived(post.info, f"{key}_epoch")
+            return utils.iso2epoch(post.info[key]) if epoch is None else epoch
+
+    elif callable(key):
+        sort_key = lambda post: key(post.info)
+    else:
+        sort_key = lambda post: post.info[key]
+
+    return (sort_key, reverse)
+
+
+def _sort_keyed(posts:   List[Post],
+                keys:    List[Any],
+                reverse: bool) -> List[Post]:
+    "Sort posts by their precomputed keys, posts with None keys last."
+    indexes = [i for i, key in enumerate(keys) if key is not None]
+    indexes.sort(key=keys.__getitem__, reverse=reverse)
+
+    return [posts[i] for i in indexes] + \
+           [post for post, key in zip(posts, keys) if key is None]
+
+
+def _top_keyed(keyed:   Iterable[Tuple[Any, Post]],
+               reverse: bool,
+               top:     int) -> List[Tuple[Any, Post]]:
+    "Return the top (key, post) pairs, posts with None keys last."
+
+    nulls: List[Tuple[Any, Post]] = []
+
+    def not_null() -> Generator[Tuple[Any, Post], None, None]:
+        for key_post in keyed:
+            if key_post[0] is not None:
+                yield key_post
+            elif len(nulls) < top:
+                nulls.append(key_post)
+
+    # Same result as sorting then slicing, stable for equal keys
+    pick = heapq.nlargest if reverse else heapq.nsmallest
+    best = pick(top, not_null(), key=lambda kp: kp[0])
+    return best + nulls[:top - len(best)]
+
+
+def _top(posts:   Iterable[Post],
+         key:     Callable[[Post], Any],
+         reverse: bool,
+         top:     int) -> List[Post]:
+
+    keyed = ((key(post), post) for post in posts)
+    return [post for _, post in _top_keyed(keyed, reverse, top)]
+
+
+def _write_run(records: List[Tuple[Any, int, bytes]],
+               reverse: bool) -> IO[bytes]:
+    records.sort(key=lambda r: r[0], reverse=reverse)
+    run = tempfile.TemporaryFile(prefix="lunafind-sort-")
+
+    for record in records:
+        pickle.dump(record, run, protocol=pickle.HIGHEST_PROTOCOL)
+
+    run.seek(0)
+    return run
+
+
+def _read_run(run: IO[bytes]) -> Generator[Tuple[Any, int, bytes], None, None]:
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+def _external_sort(posts:      Iterable[Post],
+                   key:        Callable[[Post], Any],
+                   reverse:    bool,
+                   max_memory: int) -> Generator[Post, None, None]:
+
+    # Records: (sort key, index in clients, pickled info)
+    clients: List[base.Client]             = []
+    records: List[Tuple[Any, int, bytes]] = []
+    runs:    List[IO[bytes]]               = []
+    size:    int                           = 0
+    # Records with a None key, in their original order, given last
+    nulls:   IO[bytes]                     = \
+        tempfile.TemporaryFile(prefix="lunafind-sort-")
+
+    try:
+        for post in posts:
+            if post.client not in clients:
+                clients.append(post.client)
+
+            info = post.info
+            info = pickle.dumps(
+                info._asdict() if isinstance(info, LazyInfo) else info,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+
+            record = (key(post), clients.index(post.client), info)
+
+            if record[0] is None:
+                pickle.dump(record, nulls, protocol=pickle.HIGHEST_PROTOCOL)
+                continue
+
+            records.append(record)
+            size += len(info)
+
+            if size >= max_memory:
+                runs.append(_write_run(records, reverse))
+                records, size = [], 0
+
+        if runs and records:
+            runs.append(_write_run(records, reverse))
+            records = []
+
+        if runs:
+            LOG.info("Merging %d sorted runs from disk...", len(runs))
+            merged = heapq.merge(*(_read_run(r) for r in runs),
+                                 key=lambda r: r[0], reverse=reverse)
+        else:
+            records.sort(key=lambda r: r[0], reverse=reverse)
+            merged = records
+
+        nulls.seek(0)
+
+        for _, client, info in itertools.chain(merged, _read_run(nulls)):
+            yield Post(info=pickle.loads(info), client=clients[client])
+
+    finally:
+        for run in (*runs, nulls):
+            run.close()
+
+
+def sort(posts:      Iterable[Post],
+         by:         str,
+         top:        Optional[int] = None,
+         max_memory: Optional[int] = None) -> Iterable[Post]:
+    """Return posts ordered by a `--help-order-values` method.
+
+    Posts for which the value to sort by is missing come last.
+
+    If top is set and not negative, only that many first posts are kept
+    while iterating, and posts are not all loaded in memory at once.
+
+    Else if max_memory is set, a lazy iterator is returned. Posts are
+    stored serialized, and written to temporary files in sorted runs
+    each time they exceed max_memory bytes. The runs are then merged."""
+
+    key, reverse = _key_and_reverse(by)
+    top          = parse_top(top)
 
-    by_full = by if by.startswith("asc_") or by.startswith("desc_") else \
-              f"%s_{by}" % in_dict[by][0]
+    if top is not None:
+        return _top(posts, key, reverse, top)
 
-    def sort_key(post: Post) -> int:
-        key = in_dict[by_val][1]
-        key = post.info[key] if not callable(key) else key(post.info)
-        return pend.parse(key) if in_dict == ORDER_DATE else key
+    if max_memory is not None:
+        return _external_sort(posts, key, reverse, max_memory)
 
-    posts.sort(key=sort_key, reverse=by_full.startswith("desc_"))
-    return posts
+    posts = list(posts)
+    return _sort_keyed(posts, [key(p) for p in posts], reverse)
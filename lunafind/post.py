@@ -1,9 +1,10 @@
 # Copyright 2018 miruka
 # This file is part of lunafind, licensed under LGPLv3.
 
+import asyncio
 import os
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, AsyncGenerator, List, Optional, Tuple, Union
 
 import pendulum as pend
 from atomicfile import AtomicFile
@@ -13,7 +14,7 @@ from cached_property import cached_property
 from fastnumbers import fast_int
 
 from . import LOG, utils
-from .clients import auto, base, local
+from .clients import aionet, auto, base, local
 
 
 class GotNoPostInfoError(Exception):
@@ -47,7 +48,7 @@ class Post:
         if not self.info:
             raise GotNoPostInfoError(f"Got no info for post {id_or_url!r}.")
 
-        if isinstance(info, local.IndexedInfo):
+        if isinstance(info, base.LazyInfo):
             return
 
         if "fetched_from" not in self.info:
@@ -96,17 +97,20 @@ class Post:
         return self.client.notes(self.info)
 
 
-    def download(self,
-                 base_dir:  Union[str, Path] = Path("."),
-                 overwrite: bool             = False,
-                 warn:      bool             = True) -> None:
+    def _download_targets(self,
+                          base_dir:  Union[str, Path],
+                          overwrite: bool,
+                          warn:      bool) -> List[Tuple[str, Path]]:
+        "Return (resource, path) for resources download() must write."
 
         if isinstance(self.client, local.Local):
-            return
+            return []
 
         post_dir = Path(base_dir) / "{fetched_from}-{id}".format(**self.info)
         post_dir.mkdir(parents=True, exist_ok=True)
 
+        targets = []
+
         for res in ("info", "artcom", "notes", "media"):
             if res == "media" and "file_ext" not in self.info:
                 LOG.warning("No decensor data found for post %d, "
@@ -123,26 +127,108 @@ class Post:
                     LOG.warning("Not overwriting %r", str(path))
                 continue
 
+            targets.append((res, path))
+
+        return targets
+
+
+    @staticmethod
+    def _write_json(path: Path, content: Any) -> None:
+        with AtomicFile(path, "w") as out:
+            out.write("%s%s" % (utils.jsonify(content).rstrip(), os.linesep))
+
+
+    def _log_media_download(self) -> None:
+        if self.info["file_ext"] != "zip":
+            LOG.info("Downloading %s of %s for post %d",
+                     self.info["file_ext"].upper(),
+                     utils.bytes2human(self.info["file_size"]),
+                     self.info["id"])
+        else:
+            LOG.info("Downloading WebM ugoira for post %d", self.info["id"])
+
+
+    def download(self,
+                 base_dir:  Union[str, Path] = Path("."),
+                 overwrite: bool             = False,
+                 warn:      bool             = True) -> None:
+
+        for res, path in self._download_targets(base_dir, overwrite, warn):
             content = getattr(self, res)
 
             if not content:
                 continue
 
             if res != "media":
-                with AtomicFile(path, "w") as out:
-                    out.write("%s%s" %
-                              (utils.jsonify(content).rstrip(), os.linesep))
+                self._write_json(path, content)
                 continue
 
-            if self.info["file_ext"] != "zip":
-                LOG.info("Downloading %s of %s for post %d",
-                         self.info["file_ext"].upper(),
-                         utils.bytes2human(self.info["file_size"]),
-                         self.info["id"])
-            else:
-                LOG.info("Downloading WebM ugoira for post %d",
-                         self.info["id"])
+            self._log_media_download()
 
             with AtomicFile(path, "wb") as out:
                 for chunk in content:  # pylint: disable=not-an-iterable
                     out.write(chunk)
+
+
+    async def _write_chunks(self,
+                            out:    AtomicFile,
+                            first:  bytes,
+                            chunks: AsyncGenerator[bytes, None]) -> None:
+        size = len(first)
+        out.write(first)
+
+        async for chunk in chunks:
+            size += len(chunk)
+            out.write(chunk)
+
+        # For ugoiras, file_size is the size of the zip, not of the webm
+        expected = self.info.get("file_size")
+
+        if self.info["file_ext"] != "zip" and expected and size != expected:
+            raise aionet.TransportError(
+                f"Got {size} bytes of media for post {self.info['id']}, "
+                f"expected {expected}"
+            )
+
+
+    async def download_async(self,
+                             base_dir:  Union[str, Path] = Path("."),
+                             overwrite: bool             = False,
+                             warn:      bool             = True) -> None:
+        """Async version of download().
+
+        Clients without async methods (see clients.aionet) are used from
+        a thread. aionet.TransportError is raised for incomplete media,
+        which isn't saved."""
+
+        if not (hasattr(self.client, "media_async") and aionet.available()):
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.download, base_dir, overwrite, warn
+            )
+            return
+
+        for res, path in self._download_targets(base_dir, overwrite, warn):
+            if res == "media":
+                chunks = self.client.media_async(self.info)
+
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    continue
+
+                self._log_media_download()
+
+                with AtomicFile(path, "wb") as out:
+                    try:
+                        await self._write_chunks(out, chunk, chunks)
+                    except BaseException:
+                        out.discard()  # Don't keep partial files
+                        raise
+
+                continue
+
+            content = self.info if res == "info" else \
+                      await getattr(self.client, f"{res}_async")(self.info)
+
+            if content:
+                self._write_json(path, content)
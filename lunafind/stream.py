@@ -1,18 +1,26 @@
 # Copyright 2018 miruka
 # This file is part of lunafind, licensed under LGPLv3.
 
+import asyncio
 import collections
+import collections.abc
+import itertools
 import time
 from copy import copy
 from pathlib import Path
 from threading import Lock, Thread
-from typing import List, Optional, Union
+from typing import (
+    Any, AsyncGenerator, AsyncIterable, Dict, Iterable, List, Optional, Set,
+    Tuple, Union
+)
 
 from dataclasses import dataclass, field
 
 from . import LOG, config, order
-from .clients import auto, base
-from .filtering import filter_all
+from .clients import aionet, auto, base
+from .filtering import (
+    FilterStage, compile_query, filter_stages, filter_stages_async
+)
 from .post import Post
 
 
@@ -30,9 +38,16 @@ class Stream(collections.Iterator):
     filter_str:     str  = ""
     stop_if_filter: str  = ""
 
-    unfinished:     List[Post] = field(init=False, default=None)
-    posts_seen:     int        = field(init=False, default=0)
-    downloaded:     int        = field(init=False, default=0)
+    unfinished:     List[Post]        = field(init=False, default=None)
+    posts_seen:     int               = field(init=False, default=0)
+    downloaded:     int               = field(init=False, default=0)
+    stages:         List[FilterStage] = field(init=False, default=None)
+
+    # (search, partial_tags) added by .filter() and .stop_if()
+    _filters:  Tuple[Tuple[str, bool], ...] = \
+        field(init=False, default=(), repr=False)
+    _stop_ifs: Tuple[Tuple[str, bool], ...] = \
+        field(init=False, default=(), repr=False)
 
     _info_gen: base.InfoGenType = \
         field(init=False, default=None, repr=False)
@@ -44,7 +59,11 @@ class Stream(collections.Iterator):
     def __post_init__(self) -> None:
         self.client     = auto.get(self.client)
         self.unfinished = []
+        self.stages     = []
+        self._search()
+
 
+    def _search(self) -> None:
         if self.location or isinstance(self.query, Path):
             self._info_gen = self.client.info_location(self.query)
         else:
@@ -53,28 +72,51 @@ class Stream(collections.Iterator):
                 partial_tags = True if self.partial_tags else False
             )
 
+
+    def _make_stages(self) -> None:
         auto_filter = config.CFG["GENERAL"]["auto_filter"]
-        if not self.filter_str.startswith(auto_filter):
-            self.filter_str = " ".join((self.filter_str, auto_filter)).strip()
+
+        searches = [("auto_filter", auto_filter,         False),
+                    ("filter",      self.filter_str,     self.partial_tags),
+                    *(("filter",  *args) for args in self._filters),
+                    ("stop_if",     self.stop_if_filter, self.partial_tags),
+                    *(("stop_if", *args) for args in self._stop_ifs)]
+
+        # Not appending: copies made by .filter() share the original's list
+        self.stages = []
+
+        for name, search, partial_tags in searches:
+            if not search.strip():
+                continue
+
+            query = compile_query(search, self.raw, partial_tags)
+
+            self.stages.append(FilterStage(
+                name      = name,
+                query     = query,
+                stop      = name == "stop_if",
+                estimates = self.client.tag_frequencies(query.tags)
+            ))
 
 
     def _apply_filters(self) -> None:
-        if self.filter_str:
-            self._info_gen = filter_all(
-                items        = self._info_gen,
-                terms        = self.filter_str,
-                raw          = self.raw,
-                partial_tags = self.partial_tags
-            )
+        self._make_stages()
 
-        if self.stop_if_filter.strip():
-            self._info_gen = filter_all(
-                items         = self._info_gen,
-                terms         = self.stop_if_filter,
-                raw           = self.raw,
-                stop_on_match = True,
-                partial_tags  = self.partial_tags
-            )
+        if self.stages:
+            self._info_gen = filter_stages(self._info_gen, self.stages)
+
+
+    @property
+    def discarded(self) -> Dict[str, int]:
+        "Number of posts discarded so far by the auto_filter/filter stages."
+        discarded: Dict[str, int] = {}
+
+        for stage in self.stages:
+            if not stage.stop:
+                discarded[stage.name] = \
+                    discarded.get(stage.name, 0) + stage.discarded
+
+        return discarded
 
 
     def _on_iter_done(self, discarded: int) -> None:
@@ -116,20 +158,47 @@ class Stream(collections.Iterator):
 
     # pylint: disable=protected-access
     def filter(self, search: str, partial_tags: bool = False) -> "Stream":
-        new              = copy(self)
-        new.filter_str   = " ".join((search, new.filter_str)).strip()
-        new.partial_tags = partial_tags
+        new          = copy(self)
+        new._filters = (*new._filters, (search, partial_tags))
         return new
 
     def stop_if(self, search: str, partial_tags: bool = False) -> "Stream":
-        new                = copy(self)
-        new.stop_if_filter = " ".join((search, new.stop_if_filter)).strip()
-        new.partial_tags   = partial_tags
+        new           = copy(self)
+        new._stop_ifs = (*new._stop_ifs, (search, partial_tags))
         return new
 
-    def order(self, by: str) -> "Album":
+    def natively_ordered(self, by: str) -> Optional["Stream"]:
+        """Return a copy of this stream getting posts already ordered.
+
+        The ordering is added to the search if the client supports it,
+        pages and limit then apply to the ordered results.
+        None is returned if that isn't possible, or the stream started."""
+
+        if self._applied_filters or self.location or self.random or \
+           self.raw or isinstance(self.query, Path):
+            return None
+
+        method, descending = order.parse_by(by)
+        query = self.client.ordered_search(self.query, method, descending)
+
+        if query is None:
+            return None
+
+        new       = copy(self)
+        new.query = query
+        new._search()
+        return new
+
+
+    def order(self, by: str, top: Optional[int] = None) -> "Album":
         from .album import Album  # ævoid circular dependency
-        return Album(*order.sort(list(self), by))
+
+        ordered = self.natively_ordered(by)
+
+        if ordered:
+            return Album(*itertools.islice(ordered, order.parse_top(top)))
+
+        return Album(*order.sort(self, by, top))
 
     __truediv__  = lambda self, search: self.filter(search)        # /
     __floordiv__ = lambda self, search: self.filter(search, True)  # //
@@ -175,3 +244,228 @@ class Stream(collections.Iterator):
             pass
 
         return self
+
+
+# Number of posts a thread gets at once from blocking clients for AsyncStream
+OFFLOAD_BATCH = 64
+
+
+async def download_async(posts:       Union[Iterable[Post],
+                                            AsyncIterable[Post]],
+                         base_dir:    Union[str, Path] = Path("."),
+                         overwrite:   bool             = False,
+                         warn:        bool             = True,
+                         concurrency: Optional[int]    = None) -> int:
+    """Download posts with a bounded number of downloads running at once.
+
+    The next post is only taken from posts when a download slot is free.
+    Default concurrency is the `parallel_requests` config value.
+    Return the number of finished downloads."""
+
+    limit   = concurrency or int(config.CFG["GENERAL"]["parallel_requests"])
+    running: Set[asyncio.Future] = set()
+    done    = 0
+
+    async def wait(return_when: str) -> None:
+        nonlocal running, done
+        finished, running = await asyncio.wait(running,
+                                               return_when=return_when)
+        for task in finished:
+            if task.exception():
+                LOG.error("Download failed: %r", task.exception())
+            else:
+                done += 1
+
+    if not hasattr(posts, "__aiter__"):
+        posts = _aiter(posts)
+
+    try:
+        async for post in posts:
+            if len(running) >= limit:
+                await wait(asyncio.FIRST_COMPLETED)
+
+            running.add(asyncio.ensure_future(post.download_async(
+                base_dir=base_dir, overwrite=overwrite, warn=warn
+            )))
+
+        if running:
+            await wait(asyncio.ALL_COMPLETED)
+
+    finally:
+        for task in running:
+            task.cancel()
+
+    return done
+
+
+async def _aiter(items: Iterable[Post]) -> AsyncGenerator[Post, None]:
+    for item in items:
+        yield item
+
+
+class AsyncStream(collections.abc.AsyncIterator):
+    """Asynchronous Stream, to use with `async for`.
+
+    Takes the same arguments as Stream. Clients with async methods
+    (see clients.aionet) are used directly, blocking clients from threads
+    which take OFFLOAD_BATCH posts at once."""
+
+    def __init__(self, *stream_args, _stream: Optional[Stream] = None,
+                 **stream_kwargs) -> None:
+        self.stream:     Stream = _stream or Stream(*stream_args,
+                                                    **stream_kwargs)
+        self.downloaded: int    = 0
+
+        self._posts: Optional[AsyncGenerator[Post, None]] = None
+
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.stream!r})"
+
+
+    @property
+    def posts_seen(self) -> int:
+        return self.stream.posts_seen
+
+    @property
+    def stages(self) -> List[FilterStage]:
+        return self.stream.stages
+
+    @property
+    def discarded(self) -> Dict[str, int]:
+        return self.stream.discarded
+
+
+    def _native(self) -> bool:
+        stream = self.stream
+        return hasattr(stream.client, "info_search_async") and \
+               aionet.available() and \
+               not (stream.location or isinstance(stream.query, Path))
+
+
+    # pylint: disable=protected-access
+    async def _generate(self) -> AsyncGenerator[Post, None]:
+        stream = self.stream
+
+        if not self._native():
+            loop = asyncio.get_event_loop()
+            take = lambda: list(itertools.islice(stream, OFFLOAD_BATCH))
+
+            while True:
+                posts = await loop.run_in_executor(None, take)
+
+                for post in posts:
+                    yield post
+
+                if len(posts) < OFFLOAD_BATCH:
+                    return
+
+        stream._make_stages()
+        stream._applied_filters = True
+
+        infos = stream.client.info_search_async(
+            stream.query, stream.pages, stream.limit, stream.random,
+            stream.raw, partial_tags = True if stream.partial_tags else False
+        )
+
+        if stream.stages:
+            infos = filter_stages_async(infos, stream.stages)
+
+        async for info in infos:
+            stream.posts_seen += 1
+            yield Post(info=info, client=stream.client)
+
+        stream._on_iter_done(discarded=sum(stream.discarded.values()))
+
+
+    def __aiter__(self) -> "AsyncStream":
+        return self
+
+
+    async def __anext__(self) -> Post:
+        if self._posts is None:
+            self._posts = self._generate()
+
+        return await self._posts.__anext__()
+
+
+    async def aclose(self) -> None:
+        "Stop the iteration, cancelling pending page requests."
+        if self._posts is not None:
+            await self._posts.aclose()
+
+
+    def filter(self, search: str, partial_tags: bool = False
+              ) -> "AsyncStream":
+        return AsyncStream(_stream=self.stream.filter(search, partial_tags))
+
+    def stop_if(self, search: str, partial_tags: bool = False
+               ) -> "AsyncStream":
+        return AsyncStream(_stream=self.stream.stop_if(search, partial_tags))
+
+    # pylint: disable=protected-access
+    async def order(self, by: str, top: Optional[int] = None
+                   ) -> "AsyncAlbum":
+        from .album import AsyncAlbum  # ævoid circular dependency
+
+        ordered = self.stream.natively_ordered(by)
+        top     = order.parse_top(top)
+
+        if ordered:
+            posts = AsyncStream(_stream=ordered)
+
+            try:
+                return AsyncAlbum(*[p async for p in _islice(posts, top)])
+            finally:
+                await posts.aclose()
+
+        if top is None:
+            return AsyncAlbum(*order.sort([p async for p in self], by))
+
+        # Sort by batches to keep only the top posts in memory, keys are
+        # computed once per post since some are random
+        key, reverse = order._key_and_reverse(by)
+        best:  List[Tuple[Any, Post]] = []
+        batch: List[Tuple[Any, Post]] = []
+
+        async for post in self:
+            batch.append((key(post), post))
+
+            if len(batch) >= max(top, OFFLOAD_BATCH):
+                best  = order._top_keyed(best + batch, reverse, top)
+                batch = []
+
+        best = order._top_keyed(best + batch, reverse, top)
+        return AsyncAlbum(*(post for _, post in best))
+
+    __truediv__  = lambda self, search: self.filter(search)        # /
+    __floordiv__ = lambda self, search: self.filter(search, True)  # //
+    __mod__      = lambda self, by:     self.order(by)             # %
+
+
+    async def download(self,
+                       base_dir:    Union[str, Path] = Path("."),
+                       overwrite:   bool             = False,
+                       warn:        bool             = True,
+                       concurrency: Optional[int]    = None
+                      ) -> "AsyncStream":
+
+        self.downloaded += await download_async(
+            self, base_dir, overwrite, warn, concurrency
+        )
+        return self
+
+
+async def _islice(posts: AsyncIterable[Post], stop: Optional[int]
+                 ) -> AsyncGenerator[Post, None]:
+    if stop is not None and stop <= 0:
+        return
+
+    count = 0
+
+    async for post in posts:
+        yield post
+        count += 1
+
+        if stop is not None and count >= stop:
+            return
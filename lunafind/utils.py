@@ -3,9 +3,14 @@
 
 "Misc useful functions."
 
+import calendar
+import functools
+import itertools
+import math
+import random
 import re
 import sys
-from typing import Union
+from typing import Iterable, List, Optional, Pattern, TypeVar, Union
 
 import pendulum as pend
 import simplejson
@@ -14,6 +19,8 @@ from colorama import Fore, Back, Style
 # pylint: disable=no-name-in-module
 from fastnumbers import fast_float, fast_int
 
+T = TypeVar("T")
+
 SIZE_UNITS = "BKMGTPEZY"
 
 def bytes2human(size: Union[int, float], prefix: str = "", suffix: str = ""
@@ -89,8 +96,87 @@ def age2date(age: str) -> pend.DateTime:
     return pend.now().subtract(**{found_unit: value})
 
 
+# Format used by Danbooru and fetched_at: 2018-10-01T12:34:56.789-04:00
+ISO_DATE_RE = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?"
+    r"(Z|[+-]\d\d:?\d\d)$"
+)
+
+def date2epoch(date: pend.DateTime) -> int:
+    "Return microseconds since the epoch for a timezone-aware date."
+    return calendar.timegm(date.utctimetuple()) * 1_000_000 + date.microsecond
+
+
+def iso2epoch(value: str) -> Optional[int]:
+    """Return microseconds since the epoch for a date string, None if invalid.
+
+    Dates without timezone are considered local."""
+
+    match = ISO_DATE_RE.match(value or "")
+
+    if not match:
+        try:
+            return date2epoch(pend.parse(value, tz="local"))
+        except (ValueError, TypeError, pend.parsing.exceptions.ParserError):
+            return None
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+
+    seconds = calendar.timegm((int(year), int(month), int(day),
+                               int(hour), int(minute), int(second)))
+
+    if zone != "Z":
+        offset   = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        seconds -= offset if zone[0] == "+" else -offset
+
+    return seconds * 1_000_000 + int((fraction or "0").ljust(6, "0"))
+
+
 JSONIFY_DEFAULT_PARAMS = {"sort_keys": True, "ensure_ascii": False}
 
+def reservoir_sample(items: Iterable[T],
+                     k:     int,
+                     rng:   Optional[random.Random] = None) -> List[T]:
+    """Return k random items from an iterable using O(k) memory.
+
+    If there are less than k items, all of them are returned.
+    The order of the returned list is not random."""
+
+    rng = rng or random.Random()
+
+    def uniform() -> float:  # In (0, 1), log() doesn't accept 0
+        value = 0.0
+        while not value:
+            value = rng.random()
+        return value
+
+    items     = iter(items)
+    reservoir = list(itertools.islice(items, k))
+
+    if len(reservoir) < k or k < 1:
+        return reservoir
+
+    # Algorithm L: jump directly to the next item to put in the reservoir
+    weight = math.exp(math.log(uniform()) / k)
+
+    while True:
+        skip = math.floor(math.log(uniform()) / math.log(1 - weight))
+
+        try:
+            item = next(itertools.islice(items, skip, None))
+        except StopIteration:
+            return reservoir
+
+        reservoir[rng.randrange(k)] = item
+        weight *= math.exp(math.log(uniform()) / k)
+
+
+@functools.lru_cache(maxsize=1024)
+def wildcard2regex(tag: str) -> Pattern:
+    "Compile a tag with * wildcards to a regex for fullmatch() on tags."
+    return re.compile(re.escape(tag).replace(r"\*", ".*"), re.IGNORECASE)
+
+
 def jsonify(dict_: dict, **dumps_kwargs) -> str:
     kwargs = {**JSONIFY_DEFAULT_PARAMS, **dumps_kwargs}
     return simplejson.dumps(dict_, **kwargs)
@@ -44,6 +44,13 @@ setup(
         "whratio>=3.1.1",
     ],
 
+    extras_require = {
+        # Faster filtering of big local post collections
+        "fast": ["numpy"],
+        # Asyncio network transport, see lunafind.clients.aionet
+        "async": ["aiohttp"],
+    },
+
     include_package_data = True,
     package_data         = {__about__.__pkg_name__: ["data/*"]},
     packages             = find_packages(),
@@ -0,0 +1,19 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+import pytest
+
+from lunafind.clients.danbooru import Danbooru
+
+
+@pytest.mark.parametrize("tags", ["", "touhou", "order:id", "order:id_desc"])
+def test_seek_plan_id_order(tags):
+    assert Danbooru()._seek_plan({"tags": tags}, "all", 50)
+
+
+@pytest.mark.parametrize("tags", [
+    "order:score", "ordfav:someone", "touhou ordpool:123",
+    "ordfavgroup:456", "OrdFav:someone order:id",
+])
+def test_seek_plan_other_order(tags):
+    assert Danbooru()._seek_plan({"tags": tags}, "all", 50) is None
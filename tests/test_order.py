@@ -0,0 +1,58 @@
+# Copyright 2018 miruka
+# This file is part of lunafind, licensed under LGPLv3.
+
+import pytest
+
+from lunafind import Album, Stream, order
+from lunafind.clients.danbooru import Danbooru
+from lunafind.post import Post
+
+
+def posts(*scores):
+    return [Post(info={"id": i, "score": score, "fetched_from": "danbooru"})
+            for i, score in enumerate(scores, 1)]
+
+
+def scores(ordered):
+    return [post.info["score"] for post in ordered]
+
+
+@pytest.mark.parametrize("top", [None, -1, -10])
+def test_sort_no_top(top):
+    assert scores(order.sort(posts(3, 1, 2), "score", top)) == [3, 2, 1]
+
+
+@pytest.mark.parametrize("top, expected",
+                         [(0, []), (2, [3, 2]), (5, [3, 2, 1])])
+def test_sort_top(top, expected):
+    assert scores(order.sort(posts(3, 1, 2), "score", top)) == expected
+
+
+def test_sort_missing_keys_last():
+    assert scores(order.sort(posts(None, 1, 2), "score", 2)) == [2, 1]
+    assert scores(order.sort(posts(None, 1, 2), "score")) == [2, 1, None]
+
+
+@pytest.mark.parametrize("top, expected",
+                         [(-1, [3, 2, 1]), (0, []), (1, [3])])
+def test_album_order_top(top, expected):
+    assert scores(Album(*posts(3, 1, 2)).order("score", top).list) == expected
+
+
+class OrderingClient(Danbooru):
+    "Client answering searches with posts ordered by descending score."
+
+    def info_search(self, tags="", pages=1, limit=None, random=False,
+                    raw=False, partial_tags=False):
+        assert "order:score" in tags
+        for i, score in enumerate((3, 2, 1), 1):
+            yield {"id": i, "score": score, "tag_string": "",
+                   "fetched_from": self.name}
+
+
+@pytest.mark.parametrize("top, expected",
+                         [(-1, [3, 2, 1]), (0, []), (2, [3, 2])])
+def test_stream_order_native_top(top, expected):
+    stream = Stream("", client=OrderingClient())
+    assert stream.natively_ordered("score")
+    assert scores(stream.order("score", top).list) == expected